@@ -22,6 +22,8 @@ ADMIN_TELEGRAM_ID = int(os.environ.get("ADMIN_TELEGRAM_ID")) if os.environ.get("
 DEEPSEEK_API_KEY = os.environ.get("DEEPSEEK_API_KEY")
 DEEPSEEK_API_URL = "https://api.deepseek.com/v1/chat/completions"
 DEEPSEEK_MODEL_NAME = "deepseek-chat"
+# Сколько запросов к DeepSeek legacy-модуль src/services/llm.py держит одновременно.
+DEEPSEEK_MAX_CONCURRENCY = int(os.environ.get("DEEPSEEK_MAX_CONCURRENCY", 16))
 YANDEX_SPEECHKIT_API_KEY = os.environ.get("YANDEX_SPEECHKIT_API_KEY")
 YANDEX_SPEECHKIT_FOLDER_ID = os.environ.get("YANDEX_SPEECHKIT_FOLDER_ID")
 
@@ -33,12 +35,31 @@ DB_PORT = os.environ.get("DB_PORT", "5432")
 DB_NAME = os.environ.get("DB_NAME", "voice_notes_bot_db")
 DATABASE_URL = f"postgresql://{DB_USER}:{quote_plus(DB_PASSWORD or '')}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
+# Параметры asyncpg-пула (legacy src/database/*). Каждый репозиторий делает
+# pool.acquire() на вызов, поэтому max_size ограничивает параллелизм хендлеров.
+# statement_cache_size поднят с дефолтных 100: в репозиториях заметно больше
+# уникальных запросов, и при вытеснении из LRU asyncpg заново их подготавливает.
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", 2))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", 10))
+DB_POOL_MAX_INACTIVE_CONNECTION_LIFETIME = float(os.environ.get("DB_POOL_MAX_INACTIVE_CONNECTION_LIFETIME", 300.0))
+DB_STATEMENT_CACHE_SIZE = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", 1024))
+DB_MAX_CACHED_STATEMENT_LIFETIME = int(os.environ.get("DB_MAX_CACHED_STATEMENT_LIFETIME", 0))
+
+# Пакетная запись аналитики user_actions (user_repo.log_user_action): размер
+# пачки executemany и максимальное ожидание её набора.
+USER_ACTIONS_BATCH_SIZE = int(os.environ.get("USER_ACTIONS_BATCH_SIZE", 500))
+USER_ACTIONS_FLUSH_INTERVAL_SECONDS = float(os.environ.get("USER_ACTIONS_FLUSH_INTERVAL_SECONDS", 0.2))
+
 # --- Redis Configuration ---
 REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
 REDIS_PORT = os.environ.get("REDIS_PORT", 6379)
 REDIS_DB = int(os.environ.get("REDIS_DB", 0))
 REDIS_USERNAME = os.environ.get("REDIS_USERNAME")
 REDIS_PASSWORD = os.environ.get("REDIS_PASSWORD")
+# Размер пула соединений клиента кэша (cache_service), не FSM-хранилища aiogram.
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", 64))
+# Сколько команда ждёт свободное соединение из пула, прежде чем упасть.
+REDIS_POOL_TIMEOUT_SECONDS = float(os.environ.get("REDIS_POOL_TIMEOUT_SECONDS", 5))
 
 if REDIS_USERNAME and REDIS_PASSWORD:
     REDIS_URL = f"redis://{REDIS_USERNAME}:{REDIS_PASSWORD}@{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}"
@@ -4,7 +4,14 @@ import logging
 
 import asyncpg
 
-from src.core.config import DATABASE_URL
+from src.core.config import (
+    DATABASE_URL,
+    DB_MAX_CACHED_STATEMENT_LIFETIME,
+    DB_POOL_MAX_INACTIVE_CONNECTION_LIFETIME,
+    DB_POOL_MAX_SIZE,
+    DB_POOL_MIN_SIZE,
+    DB_STATEMENT_CACHE_SIZE,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -275,6 +282,51 @@ CREATE_AND_UPDATE_TABLES_STATEMENTS = [
     "CREATE INDEX IF NOT EXISTS idx_habits_user_id ON habits(user_telegram_id);",
     "CREATE INDEX IF NOT EXISTS idx_habit_trackings_habit_id ON habit_trackings(habit_id);",
     "CREATE INDEX IF NOT EXISTS idx_chat_topic_settings_chat_topic ON chat_topic_settings(chat_id, topic_id);",
+    "CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at DESC);",
+
+    # --- Инвалидация кэша профиля при записях вне процесса бота (user_repo слушает user_profile_changed) ---
+    """
+    CREATE OR REPLACE FUNCTION notify_user_profile_changed() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify(
+            'user_profile_changed',
+            (CASE WHEN TG_OP = 'DELETE' THEN OLD.telegram_id ELSE COALESCE(NEW.telegram_id, OLD.telegram_id) END)::text
+        );
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """,
+    # Триггеры создаются только если их нет: DROP + CREATE на каждом старте брал бы
+    # эксклюзивную блокировку общей с новым стеком таблицы users. WHEN отсекает
+    # mobile-only строки с telegram_id IS NULL; DELETE-триггер не может ссылаться
+    # на NEW, поэтому UPDATE и DELETE разнесены. Старый общий триггер без WHEN
+    # пересоздаётся один раз.
+    """
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM pg_trigger WHERE tgrelid = 'users'::regclass
+                   AND tgname = 'trg_users_profile_changed' AND tgqual IS NULL) THEN
+            DROP TRIGGER trg_users_profile_changed ON users;
+        END IF;
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgrelid = 'users'::regclass
+                       AND tgname = 'trg_users_profile_changed') THEN
+            CREATE TRIGGER trg_users_profile_changed
+                AFTER UPDATE ON users
+                FOR EACH ROW
+                WHEN (COALESCE(NEW.telegram_id, OLD.telegram_id) IS NOT NULL)
+                EXECUTE FUNCTION notify_user_profile_changed();
+        END IF;
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgrelid = 'users'::regclass
+                       AND tgname = 'trg_users_profile_deleted') THEN
+            CREATE TRIGGER trg_users_profile_deleted
+                AFTER DELETE ON users
+                FOR EACH ROW
+                WHEN (OLD.telegram_id IS NOT NULL)
+                EXECUTE FUNCTION notify_user_profile_changed();
+        END IF;
+    END;
+    $$;
+    """,
 
     # --- Mobile auth (email/password) ---
     """
@@ -630,13 +682,39 @@ END $$;
 db_pool: asyncpg.Pool | None = None
 
 
+async def _skip_connection_reset(connection: asyncpg.Connection) -> None:
+    """
+    Заменяет сброс сессии (RESET ALL / UNLISTEN / advisory unlock) при возврате
+    соединения в пул: это лишний round-trip на каждый acquire.
+
+    Безопасно, пока код поверх пула не меняет состояние сессии: не делает SET,
+    LISTEN, advisory locks и временных таблиц. Всем, кому это нужно, — отдельное
+    соединение через asyncpg.connect(), а не pool.acquire().
+    """
+    return None
+
+
 async def get_db_pool() -> asyncpg.Pool:
     """Возвращает существующий пул соединений или создает новый."""
     global db_pool
     if db_pool is None or db_pool.is_closing():
         try:
-            db_pool = await asyncpg.create_pool(dsn=DATABASE_URL, min_size=2, max_size=10, ssl=False)
-            logger.info("Пул соединений к PostgreSQL успешно создан.")
+            db_pool = await asyncpg.create_pool(
+                dsn=DATABASE_URL,
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=DB_POOL_MAX_SIZE,
+                max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_CONNECTION_LIFETIME,
+                # Без TTL у подготовленных выражений: запросы репозиториев
+                # статичны, а пересоздание стейтментов стоит лишний round-trip.
+                statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+                max_cached_statement_lifetime=DB_MAX_CACHED_STATEMENT_LIFETIME,
+                reset=_skip_connection_reset,
+                ssl=False,
+            )
+            logger.info(
+                "Пул соединений к PostgreSQL успешно создан (min=%s, max=%s).",
+                DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE,
+            )
         except Exception as e:
             logger.critical(f"Не удалось подключиться к PostgreSQL: {e}", exc_info=True)
             raise
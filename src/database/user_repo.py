@@ -1,18 +1,46 @@
 # src/database/user_repo.py
+"""Репозиторий пользователей (legacy-схема ``users``) с кэшем профиля в Redis.
+
+Контракт кэша профиля: даты/время пишутся только через ``isoformat()``
+(``_serialize_profile_for_cache``) и читаются только через ``fromisoformat()``
+(``_PROFILE_CACHE_FIELD_PARSERS``). Не вводить ``strptime``/``dateutil`` —
+``fromisoformat`` реализован на C и на порядки быстрее на горячем пути.
+"""
+import asyncio
+import functools
 import json
 import logging
+import asyncpg
+import orjson
 from datetime import datetime, timezone, date, time
 from aiogram import types, Bot
 from aiogram.utils.markdown import hbold
 
 from .connection import get_db_pool
+from ..core.config import DATABASE_URL, USER_ACTIONS_BATCH_SIZE, USER_ACTIONS_FLUSH_INTERVAL_SECONDS
 from ..services import cache_service
+from ..services.tz_utils import get_zoneinfo
 # M0: импорт ``bot_instance`` из web.routes удалён — он нужен был только для
 # gamification-зависимых функций, которые теперь no-op. Циркулярная цепочка
 # (user_repo -> web.routes -> user_repo) разорвана.
 
 logger = logging.getLogger(__name__)
 
+# Сильные ссылки на fire-and-forget задачи: event loop держит только слабые,
+# и без этого множества задачу может собрать GC до завершения.
+_background_tasks: set[asyncio.Task] = set()
+
+# Ссылка на пул, выставляемая один раз в on_startup бота (см. set_pool): на
+# горячем пути это обычное чтение глобала вместо await get_db_pool(). Процессы,
+# которые не вызвали set_pool (web, скрипты), идут через ленивый get_db_pool().
+_POOL: asyncpg.Pool | None = None
+
+
+def set_pool(pool: asyncpg.Pool | None) -> None:
+    """Запоминает пул для функций репозитория; None — сбросить при остановке."""
+    global _POOL
+    _POOL = pool
+
 
 # Устаревшие алиасы IANA tzdb, удалённые в PostgreSQL 17+. Приложение уже
 # не должно их создавать (миграция в connection.py нормализует users.timezone
@@ -27,6 +55,35 @@ _DEPRECATED_TZ_ALIASES = {
 }
 
 
+# Самые частые запросы модуля. asyncpg готовит и кэширует statement на каждом
+# соединении по тексту SQL (см. DB_STATEMENT_CACHE_SIZE) — стабильные
+# константы гарантируют, что текст не «плывёт» между вызовами.
+_Q_SELECT_USER_PROFILE = "SELECT * FROM users WHERE telegram_id = $1"
+_Q_SELECT_DEVICE_TOKENS = "SELECT array_agg(fcm_token) FROM user_devices WHERE user_telegram_id = $1"
+_Q_INSERT_USER_ACTION = "INSERT INTO user_actions (user_telegram_id, action_type, metadata) VALUES ($1, $2, $3);"
+
+# Поля профиля, которые в кэше Redis хранятся строками, и их обратные парсеры.
+_PROFILE_CACHE_FIELD_PARSERS = (
+    ('created_at', datetime.fromisoformat),
+    ('updated_at', datetime.fromisoformat),
+    ('last_stt_reset_date', date.fromisoformat),
+    ('alice_code_expires_at', datetime.fromisoformat),
+    ('default_reminder_time', time.fromisoformat),
+    ('daily_digest_time', time.fromisoformat),
+    ('viewed_guides', json.loads),
+)
+
+
+def _serialize_profile_for_cache(profile: dict) -> dict:
+    """Возвращает копию профиля, где даты/время приведены к isoformat-строкам."""
+    serialized = profile.copy()
+    for key, _ in _PROFILE_CACHE_FIELD_PARSERS:
+        value = serialized.get(key)
+        if hasattr(value, 'isoformat'):
+            serialized[key] = value.isoformat()
+    return serialized
+
+
 def normalize_timezone(tz: str | None) -> str:
     """Канонизирует IANA tzdb alias. None / пусто → 'UTC'."""
     if not tz:
@@ -34,11 +91,13 @@ def normalize_timezone(tz: str | None) -> str:
     return _DEPRECATED_TZ_ALIASES.get(tz, tz)
 
 
+@functools.lru_cache(maxsize=4096)
 def get_level_for_xp(xp: int) -> int:
     """Вычисляет уровень на основе накопленного опыта."""
     return int((xp / 100) ** 0.5) + 1
 
 
+@functools.lru_cache(maxsize=256)
 def get_xp_for_level(level: int) -> int:
     """Вычисляет необходимое количество опыта для достижения уровня."""
     if level <= 1:
@@ -55,7 +114,7 @@ async def add_or_update_user(telegram_id: int, username: str = None, first_name:
     """
     from ..services.tz_utils import guess_timezone_from_language
     
-    pool = await get_db_pool()
+    pool = _POOL or await get_db_pool()
     async with pool.acquire() as conn:
         now = datetime.now(timezone.utc)
         
@@ -94,7 +153,7 @@ async def add_or_update_user(telegram_id: int, username: str = None, first_name:
                     """
             user_record = await conn.fetchrow(query, telegram_id, username, first_name, last_name, language_code, now)
 
-        await cache_service.delete_user_profile_from_cache(telegram_id)
+        await _invalidate_profile_cache(telegram_id)
 
         return dict(user_record) if user_record else None
 
@@ -125,23 +184,17 @@ async def get_user_profile(telegram_id: int) -> dict | None:
     """Возвращает профиль пользователя по его telegram_id, используя кэш."""
     cached_profile = await cache_service.get_user_profile_from_cache(telegram_id)
     if cached_profile:
-        for key in ['created_at', 'updated_at', 'last_stt_reset_date', 'alice_code_expires_at']:
-            if key in cached_profile and isinstance(cached_profile[key], str):
-                try:
-                    cached_profile[key] = datetime.fromisoformat(cached_profile[key])
-                except (ValueError, TypeError):
-                    pass
-        if 'default_reminder_time' in cached_profile and isinstance(cached_profile['default_reminder_time'], str):
-            cached_profile['default_reminder_time'] = time.fromisoformat(cached_profile['default_reminder_time'])
-        if 'daily_digest_time' in cached_profile and isinstance(cached_profile['daily_digest_time'], str):
-            cached_profile['daily_digest_time'] = time.fromisoformat(cached_profile['daily_digest_time'])
-        if 'viewed_guides' in cached_profile and isinstance(cached_profile['viewed_guides'], str):
-             cached_profile['viewed_guides'] = json.loads(cached_profile['viewed_guides'])
+        # Кэш пишет только set_user_profile_to_cache (isoformat/JSON), поэтому
+        # формат строк гарантирован и разбор идёт без try/except.
+        for key, parser in _PROFILE_CACHE_FIELD_PARSERS:
+            value = cached_profile.get(key)
+            if type(value) is str:
+                cached_profile[key] = parser(value)
         return cached_profile
 
-    pool = await get_db_pool()
+    pool = _POOL or await get_db_pool()
     async with pool.acquire() as conn:
-        user_record = await conn.fetchrow("SELECT * FROM users WHERE telegram_id = $1", telegram_id)
+        user_record = await conn.fetchrow(_Q_SELECT_USER_PROFILE, telegram_id)
         profile = dict(user_record) if user_record else None
 
     # Phase 6: `level` — производная от `xp`. Всегда отдаём вычисленный уровень,
@@ -177,21 +230,169 @@ async def get_user_profile(telegram_id: int) -> dict | None:
         profile['timezone'] = canonical_tz
 
     if profile:
-        await cache_service.set_user_profile_to_cache(telegram_id, profile.copy())
+        await cache_service.set_user_profile_to_cache(telegram_id, _serialize_profile_for_cache(profile))
 
     return profile
 
 
+# Колонки users, которые разрешено менять через update_user_fields.
+# Имена подставляются в SQL напрямую, поэтому список закрытый.
+_UPDATABLE_USER_FIELDS = frozenset({
+    'is_vip',
+    'timezone',
+    'city_name',
+    'default_reminder_time',
+    'daily_digest_time',
+    'daily_digest_enabled',
+    'pre_reminder_minutes',
+})
+
+
+def _build_update_user_fields_query(telegram_id: int, fields: dict) -> tuple[str, list]:
+    """
+    Собирает UPDATE для update_user_fields. Строка обновляется, только если
+    хоть одно значение реально отличается (IS DISTINCT FROM), так что повторная
+    запись тех же значений не трогает updated_at и не создаёт лишнюю версию строки.
+    Запрос возвращает, изменилась ли строка (true/false), если пользователь
+    существует, и NULL — если нет.
+    """
+    sets: list[str] = []
+    changed: list[str] = []
+    params: list = []
+    # Канонический порядок колонок: один и тот же набор полей всегда даёт
+    # один и тот же текст SQL и попадает в кэш prepared statements asyncpg.
+    for column in sorted(fields):
+        params.append(fields[column])
+        sets.append(f"{column} = ${len(params)}")
+        changed.append(f"{column} IS DISTINCT FROM ${len(params)}")
+    sets.append("updated_at = NOW()")
+    params.append(telegram_id)
+    id_param = f"${len(params)}"
+    query = (
+        f"WITH upd AS (UPDATE users SET {', '.join(sets)} "
+        f"WHERE telegram_id = {id_param} AND ({' OR '.join(changed)}) RETURNING 1) "
+        f"SELECT EXISTS (SELECT 1 FROM upd) FROM users WHERE telegram_id = {id_param}"
+    )
+    return query, params
+
+
+# --- Инвалидация кэша профиля через LISTEN/NOTIFY ---
+# Триггер trg_users_profile_changed шлёт NOTIFY на любое UPDATE/DELETE в users.
+# Слушатель нужен только для писателей вне этого процесса (админка, миграции,
+# другие инстансы): свои setter'ы всегда удаляют кэш сами и синхронно, потому
+# что NOTIFY асинхронный и может прийти после следующего чтения профиля.
+_PROFILE_CHANGED_CHANNEL = 'user_profile_changed'
+_PROFILE_LISTENER_RECONNECT_DELAY_SECONDS = 5
+
+_profile_listener_task: asyncio.Task | None = None
+
+
+def _on_user_profile_changed(connection, pid, channel, payload: str):
+    # Строки без telegram_id (mobile-only аккаунты нового стека) в кэше профилей не бывают.
+    try:
+        telegram_id = int(payload)
+    except (TypeError, ValueError):
+        logger.debug(f"Пропущено уведомление {channel} с payload {payload!r}.")
+        return
+    _spawn_background(cache_service.delete_user_profile_from_cache(telegram_id))
+
+
+async def _listen_user_profile_changes():
+    """Держит отдельное соединение с LISTEN и переподключается при обрыве."""
+    loop = asyncio.get_running_loop()
+    while True:
+        conn = None
+        try:
+            # Не pool.acquire(): LISTEN — состояние сессии, а пул не сбрасывает
+            # соединения при возврате (см. connection._skip_connection_reset).
+            conn = await asyncpg.connect(dsn=DATABASE_URL, ssl=False)
+            terminated = loop.create_future()
+            conn.add_termination_listener(
+                lambda _conn: terminated.done() or terminated.set_result(None)
+            )
+            await conn.add_listener(_PROFILE_CHANGED_CHANNEL, _on_user_profile_changed)
+            logger.info("Слушатель изменений профилей пользователей подключён.")
+            await terminated
+            logger.warning("Соединение слушателя изменений профилей потеряно.")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка слушателя изменений профилей: {e}")
+        finally:
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        await asyncio.sleep(_PROFILE_LISTENER_RECONNECT_DELAY_SECONDS)
+
+
+def start_profile_cache_listener() -> None:
+    """Запускает фоновый LISTEN user_profile_changed. Вызывается из on_startup."""
+    global _profile_listener_task
+    if _profile_listener_task is None:
+        _profile_listener_task = asyncio.create_task(_listen_user_profile_changes())
+
+
+async def stop_profile_cache_listener() -> None:
+    """Останавливает слушателя и закрывает его соединение."""
+    global _profile_listener_task
+    if _profile_listener_task is None:
+        return
+    _profile_listener_task.cancel()
+    try:
+        await _profile_listener_task
+    except asyncio.CancelledError:
+        pass
+    _profile_listener_task = None
+
+
+async def _invalidate_profile_cache(telegram_id: int):
+    """Удаляет кэш профиля после записи в users."""
+    await cache_service.delete_user_profile_from_cache(telegram_id)
+
+
+async def _exec_and_invalidate(conn, telegram_id: int, query: str, *args) -> bool:
+    """
+    Выполняет запись в users и затем удаляет кэш профиля.
+
+    DEL идёт строго после записи: чтение сразу после setter'а (например,
+    PUT /me → get_user_profile) должно получить уже новую строку из БД.
+
+    Запрос обязан возвращать 1, если строка нашлась, и ничего — если нет
+    (обычно ``RETURNING 1``): fetchval отдаст 1 или None без разбора командного тега.
+    """
+    row_found = await conn.fetchval(query, *args)
+    await cache_service.delete_user_profile_from_cache(telegram_id)
+    return row_found is not None
+
+
+async def update_user_fields(telegram_id: int, **fields) -> bool:
+    """
+    Обновляет несколько настроек пользователя одним UPDATE и один раз
+    инвалидирует кэш — только если значения действительно изменились.
+    Допустимые поля — ``_UPDATABLE_USER_FIELDS``.
+    """
+    unknown = fields.keys() - _UPDATABLE_USER_FIELDS
+    if unknown:
+        raise ValueError(f"Недопустимые поля для обновления users: {sorted(unknown)}")
+    if not fields:
+        return True  # ничего не менять — успех
+
+    query, params = _build_update_user_fields_query(telegram_id, fields)
+    pool = _POOL or await get_db_pool()
+    async with pool.acquire() as conn:
+        changed = await conn.fetchval(query, *params)
+    # Повторное сохранение тех же значений не трогает строку — кэш профиля
+    # остаётся актуальным, и следующее чтение не идёт в БД.
+    if changed:
+        await cache_service.delete_user_profile_from_cache(telegram_id)
+    return changed is not None
+
+
 async def set_onboarding_status(telegram_id: int, status: bool) -> bool:
     """Устанавливает статус прохождения обучения для пользователя."""
-    pool = await get_db_pool()
+    pool = _POOL or await get_db_pool()
     async with pool.acquire() as conn:
-        query = "UPDATE users SET has_completed_onboarding = $1, updated_at = NOW() WHERE telegram_id = $2"
-        result = await conn.execute(query, status, telegram_id)
-        success = int(result.split(" ")[1]) > 0
-        if success:
-            await cache_service.delete_user_profile_from_cache(telegram_id)
-        return success
+        query = "UPDATE users SET has_completed_onboarding = $1, updated_at = NOW() WHERE telegram_id = $2 RETURNING 1"
+        return await _exec_and_invalidate(conn, telegram_id, query, status, telegram_id)
 
 
 async def set_user_vip_status(telegram_id: int, is_vip: bool) -> bool:
@@ -200,90 +401,84 @@ async def set_user_vip_status(telegram_id: int, is_vip: bool) -> bool:
     M0: вызов check_and_grant_achievements убран вместе с gamification_service.
     Поле is_vip будет вытеснено полем users.pro_until в M1 (docs/PRODUCT_PLAN.md §4.3).
     """
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        result = await conn.execute("UPDATE users SET is_vip = $1, updated_at = NOW() WHERE telegram_id = $2", is_vip,
-                                    telegram_id)
-        success = int(result.split(" ")[1]) > 0
-        if success:
-            await cache_service.delete_user_profile_from_cache(telegram_id)
-        return success
+    return await update_user_fields(telegram_id, is_vip=is_vip)
 
 
 async def reset_user_vip_settings(telegram_id: int) -> bool:
     """Сбрасывает персональные настройки VIP-пользователя и инвалидирует кэш."""
-    pool = await get_db_pool()
+    pool = _POOL or await get_db_pool()
     async with pool.acquire() as conn:
-        query = "UPDATE users SET default_reminder_time = DEFAULT, pre_reminder_minutes = DEFAULT, daily_digest_time = DEFAULT, updated_at = NOW() WHERE telegram_id = $1"
-        result = await conn.execute(query, telegram_id)
-        success = int(result.split(" ")[1]) > 0
-        if success:
-            await cache_service.delete_user_profile_from_cache(telegram_id)
-        return success
+        query = "UPDATE users SET default_reminder_time = DEFAULT, pre_reminder_minutes = DEFAULT, daily_digest_time = DEFAULT, updated_at = NOW() WHERE telegram_id = $1 RETURNING 1"
+        return await _exec_and_invalidate(conn, telegram_id, query, telegram_id)
 
 
 async def get_all_users_paginated(page: int = 1, per_page: int = 5) -> tuple[list[dict], int]:
     """Возвращает пагинированный список пользователей для админ-панели."""
-    pool = await get_db_pool()
+    pool = _POOL or await get_db_pool()
     async with pool.acquire() as conn:
-        total_items = await conn.fetchval("SELECT COUNT(*) FROM users") or 0
         offset = (page - 1) * per_page
+        # COUNT(*) OVER() отдаёт общее число строк вместе со страницей — один запрос вместо двух.
         users_records = await conn.fetch(
-            "SELECT telegram_id, username, first_name, is_vip FROM users ORDER BY created_at DESC LIMIT $1 OFFSET $2",
+            "SELECT telegram_id, username, first_name, is_vip, COUNT(*) OVER() AS total_items "
+            "FROM users ORDER BY created_at DESC LIMIT $1 OFFSET $2",
             per_page, offset)
-        return [dict(record) for record in users_records], total_items
+        if users_records:
+            total_items = users_records[0]['total_items']
+        else:
+            # Страница за пределами списка — оконная функция ничего не вернула.
+            total_items = await conn.fetchval("SELECT COUNT(*) FROM users") or 0
+
+    users = []
+    for record in users_records:
+        user = dict(record)
+        del user['total_items']
+        users.append(user)
+    return users, total_items
 
 
 async def update_user_stt_counters(telegram_id: int, new_count: int, reset_date: date) -> bool:
     """Обновляет счетчик STT и инвалидирует кэш."""
-    pool = await get_db_pool()
+    pool = _POOL or await get_db_pool()
     async with pool.acquire() as conn:
-        result = await conn.execute(
-            "UPDATE users SET daily_stt_recognitions_count = $1, last_stt_reset_date = $2, updated_at = NOW() WHERE telegram_id = $3",
-            new_count, reset_date, telegram_id)
-        success = int(result.split(" ")[1]) > 0
-        if success:
-            await cache_service.delete_user_profile_from_cache(telegram_id)
-        return success
+        return await _exec_and_invalidate(
+            conn, telegram_id,
+            "UPDATE users SET daily_stt_recognitions_count = $1, last_stt_reset_date = $2, updated_at = NOW() WHERE telegram_id = $3 RETURNING 1",
+            new_count, reset_date, telegram_id,
+        )
 
 
 async def set_user_daily_digest_status(telegram_id: int, enabled: bool) -> bool:
     """Включает или выключает утреннюю сводку и инвалидирует кэш."""
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        query = "UPDATE users SET daily_digest_enabled = $1, updated_at = NOW() WHERE telegram_id = $2"
-        result = await conn.execute(query, enabled, telegram_id)
-        success = int(result.split(" ")[1]) > 0
-        if success:
-            await cache_service.delete_user_profile_from_cache(telegram_id)
-        return success
+    return await update_user_fields(telegram_id, daily_digest_enabled=enabled)
 
 
 async def get_vip_users_for_digest() -> list[dict]:
-    """Возвращает VIP-пользователей для отправки утренней сводки."""
-    pool = await get_db_pool()
+    """
+    Возвращает VIP-пользователей для отправки утренней сводки.
+
+    Сравнение «сейчас час сводки в поясе пользователя» делается в Python,
+    а не через ``NOW() AT TIME ZONE`` по каждой строке в Postgres.
+    """
+    pool = _POOL or await get_db_pool()
     async with pool.acquire() as conn:
         query = """
                 SELECT telegram_id, first_name, timezone, daily_digest_time, city_name
                 FROM users
                 WHERE is_vip = TRUE
                   AND daily_digest_enabled = TRUE
-                  AND EXTRACT(HOUR FROM (NOW() AT TIME ZONE timezone)) = EXTRACT(HOUR FROM daily_digest_time);
+                  AND daily_digest_time IS NOT NULL;
                 """
         records = await conn.fetch(query)
-        return [dict(rec) for rec in records]
+    now_utc = datetime.now(timezone.utc)
+    return [
+        dict(rec) for rec in records
+        if now_utc.astimezone(get_zoneinfo(normalize_timezone(rec['timezone']))).hour == rec['daily_digest_time'].hour
+    ]
 
 
 async def set_user_timezone(telegram_id: int, timezone_name: str) -> bool:
     """Устанавливает часовой пояс и инвалидирует кэш."""
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        query = "UPDATE users SET timezone = $1, updated_at = NOW() WHERE telegram_id = $2"
-        result = await conn.execute(query, timezone_name, telegram_id)
-        success = int(result.split(" ")[1]) > 0
-        if success:
-            await cache_service.delete_user_profile_from_cache(telegram_id)
-        return success
+    return await update_user_fields(telegram_id, timezone=timezone_name)
 
 
 async def set_user_city(telegram_id: int, city_name: str | None) -> bool:
@@ -291,67 +486,35 @@ async def set_user_city(telegram_id: int, city_name: str | None) -> bool:
     Устанавливает или удаляет город пользователя для прогноза погоды.
     Инвалидирует кэш профиля.
     """
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        query = "UPDATE users SET city_name = $1, updated_at = NOW() WHERE telegram_id = $2"
-        result = await conn.execute(query, city_name, telegram_id)
-        success = int(result.split(" ")[1]) > 0
-        if success:
-            await cache_service.delete_user_profile_from_cache(telegram_id)
-        return success
+    return await update_user_fields(telegram_id, city_name=city_name)
 
 
 async def set_user_default_reminder_time(telegram_id: int, reminder_time: time) -> bool:
     """Устанавливает время напоминаний и инвалидирует кэш."""
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        query = "UPDATE users SET default_reminder_time = $1, updated_at = NOW() WHERE telegram_id = $2"
-        result = await conn.execute(query, reminder_time, telegram_id)
-        success = int(result.split(" ")[1]) > 0
-        if success:
-            await cache_service.delete_user_profile_from_cache(telegram_id)
-        return success
+    return await update_user_fields(telegram_id, default_reminder_time=reminder_time)
 
 
 async def set_user_daily_digest_time(telegram_id: int, digest_time: time) -> bool:
     """Устанавливает время сводки и инвалидирует кэш."""
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        query = "UPDATE users SET daily_digest_time = $1, updated_at = NOW() WHERE telegram_id = $2"
-        result = await conn.execute(query, digest_time, telegram_id)
-        success = int(result.split(" ")[1]) > 0
-        if success:
-            await cache_service.delete_user_profile_from_cache(telegram_id)
-        return success
+    return await update_user_fields(telegram_id, daily_digest_time=digest_time)
 
 
 async def set_user_pre_reminder_minutes(telegram_id: int, minutes: int) -> bool:
     """Устанавливает время пред-напоминания и инвалидирует кэш."""
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        query = "UPDATE users SET pre_reminder_minutes = $1, updated_at = NOW() WHERE telegram_id = $2"
-        result = await conn.execute(query, minutes, telegram_id)
-        success = int(result.split(" ")[1]) > 0
-        if success:
-            await cache_service.delete_user_profile_from_cache(telegram_id)
-        return success
+    return await update_user_fields(telegram_id, pre_reminder_minutes=minutes)
 
 
 async def set_alice_activation_code(telegram_id: int, code: str, expires_at: datetime) -> bool:
     """Сохраняет код активации и инвалидирует кэш."""
-    pool = await get_db_pool()
+    pool = _POOL or await get_db_pool()
     async with pool.acquire() as conn:
-        query = "UPDATE users SET alice_activation_code = $1, alice_code_expires_at = $2 WHERE telegram_id = $3"
-        result = await conn.execute(query, code, expires_at, telegram_id)
-        success = int(result.split(" ")[1]) > 0
-        if success:
-            await cache_service.delete_user_profile_from_cache(telegram_id)
-        return success
+        query = "UPDATE users SET alice_activation_code = $1, alice_code_expires_at = $2 WHERE telegram_id = $3 RETURNING 1"
+        return await _exec_and_invalidate(conn, telegram_id, query, code, expires_at, telegram_id)
 
 
 async def find_user_by_alice_code(code: str) -> dict | None:
     """Находит пользователя по коду активации Алисы."""
-    pool = await get_db_pool()
+    pool = _POOL or await get_db_pool()
     async with pool.acquire() as conn:
         query = "SELECT * FROM users WHERE alice_activation_code = $1 AND alice_code_expires_at > NOW()"
         record = await conn.fetchrow(query, code)
@@ -360,60 +523,162 @@ async def find_user_by_alice_code(code: str) -> dict | None:
 
 async def link_alice_user(telegram_id: int, alice_id: str) -> bool:
     """Привязывает ID Алисы и инвалидирует кэш."""
-    pool = await get_db_pool()
+    pool = _POOL or await get_db_pool()
     async with pool.acquire() as conn:
-        query = "UPDATE users SET alice_user_id = $1, alice_activation_code = NULL, alice_code_expires_at = NULL, updated_at = NOW() WHERE telegram_id = $2"
-        result = await conn.execute(query, alice_id, telegram_id)
-        success = int(result.split(" ")[1]) > 0
-        if success:
-            await cache_service.delete_user_profile_from_cache(telegram_id)
-        return success
+        query = "UPDATE users SET alice_user_id = $1, alice_activation_code = NULL, alice_code_expires_at = NULL, updated_at = NOW() WHERE telegram_id = $2 RETURNING 1"
+        return await _exec_and_invalidate(conn, telegram_id, query, alice_id, telegram_id)
 
 
 async def find_user_by_alice_id(alice_id: str) -> dict | None:
     """Находит пользователя по его ID из Алисы."""
-    pool = await get_db_pool()
+    pool = _POOL or await get_db_pool()
     async with pool.acquire() as conn:
         query = "SELECT * FROM users WHERE alice_user_id = $1"
         record = await conn.fetchrow(query, alice_id)
         return dict(record) if record else None
 
 
-async def log_user_action(user_telegram_id: int, action_type: str, metadata: dict = None):
-    """Логирует действие пользователя для аналитики."""
-    pool = await get_db_pool()
-    metadata_json = json.dumps(metadata) if metadata else None
-    query = "INSERT INTO user_actions (user_telegram_id, action_type, metadata) VALUES ($1, $2, $3);"
+# Очередь аналитики: log_user_action кладёт запись и сразу возвращается,
+# единственный фоновый потребитель пишет пачками. Пока очередь не запущена
+# (start_user_action_logger), запись уходит одиночной фоновой задачей.
+# Пачка пишется одним executemany: INSERT разбирается один раз на соединение,
+# дальше только bind/execute на каждую строку.
+_LOG_QUEUE_MAXSIZE = 10_000
+_LOG_BATCH_SIZE = USER_ACTIONS_BATCH_SIZE
+_LOG_FLUSH_INTERVAL_SECONDS = USER_ACTIONS_FLUSH_INTERVAL_SECONDS
+
+_log_queue: asyncio.Queue | None = None
+_log_consumer_task: asyncio.Task | None = None
+# Маркер остановки: потребитель дописывает набранную пачку и завершается сам.
+_LOG_STOP = object()
+
+
+async def _write_user_actions(batch: list[tuple]):
+    pool = _POOL or await get_db_pool()
     try:
         async with pool.acquire() as conn:
-            await conn.execute(query, user_telegram_id, action_type, metadata_json)
+            await conn.executemany(_Q_INSERT_USER_ACTION, batch)
     except Exception as e:
-        logger.error(f"Ошибка логирования действия '{action_type}' для {user_telegram_id}: {e}")
+        logger.error(f"Ошибка записи {len(batch)} действий пользователей в user_actions: {e}")
+
+
+async def _log_consumer(queue: asyncio.Queue):
+    """
+    Собирает до _LOG_BATCH_SIZE записей или ждёт _LOG_FLUSH_INTERVAL_SECONDS и пишет пачку.
+    На _LOG_STOP дописывает набранное и завершается.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        first = await queue.get()
+        if first is _LOG_STOP:
+            return
+        batch = [first]
+        stopping = False
+        deadline = loop.time() + _LOG_FLUSH_INTERVAL_SECONDS
+        while len(batch) < _LOG_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                record = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if record is _LOG_STOP:
+                stopping = True
+                break
+            batch.append(record)
+        await _write_user_actions(batch)
+        if stopping:
+            return
+
+
+def start_user_action_logger() -> None:
+    """Запускает фоновую запись аналитики. Вызывается из on_startup."""
+    global _log_queue, _log_consumer_task
+    if _log_consumer_task is not None:
+        return
+    _log_queue = asyncio.Queue(maxsize=_LOG_QUEUE_MAXSIZE)
+    _log_consumer_task = asyncio.create_task(_log_consumer(_log_queue))
+
+
+async def stop_user_action_logger() -> None:
+    """
+    Останавливает потребителя без потери записей: маркер в очереди даёт ему
+    дописать уже набранную пачку и всё, что стояло перед маркером.
+    """
+    global _log_queue, _log_consumer_task
+    if _log_consumer_task is None:
+        return
+    queue, task = _log_queue, _log_consumer_task
+    # Новые записи с этого момента пишутся напрямую (см. log_user_action),
+    # поэтому очередь больше никто не трогает и маркер не может быть вытеснен.
+    _log_queue, _log_consumer_task = None, None
+    await queue.put(_LOG_STOP)
+    await task
+
+
+async def log_user_action(user_telegram_id: int, action_type: str, metadata: dict = None):
+    """
+    Логирует действие пользователя для аналитики.
+
+    Запись не ждёт round-trip до БД; порядок строк в user_actions не
+    гарантируется. При переполненной очереди теряется самая старая запись.
+    """
+    metadata_json = orjson.dumps(metadata).decode() if metadata else None
+    record = (user_telegram_id, action_type, metadata_json)
+    if _log_queue is None:
+        _spawn_background(_write_user_actions([record]))
+        return
+    if _log_queue.full():
+        _log_queue.get_nowait()
+        logger.warning("Очередь аналитики переполнена, самая старая запись отброшена.")
+    _log_queue.put_nowait(record)
 
 
 async def add_xp_and_check_level_up(bot: Bot, user_id: int, amount: int, silent_level_up: bool = False):
-    """Добавляет опыт пользователю и проверяет повышение уровня."""
-    pool = await get_db_pool()
+    """
+    Добавляет опыт пользователю и проверяет повышение уровня.
+    Опыт и уровень пересчитываются одним UPDATE ... RETURNING; формула уровня
+    в SQL повторяет get_level_for_xp.
+    """
+    pool = _POOL or await get_db_pool()
     async with pool.acquire() as conn:
-        await conn.execute("UPDATE users SET xp = xp + $1 WHERE telegram_id = $2", amount, user_id)
+        user = await conn.fetchrow(
+            """
+            UPDATE users
+            SET xp = xp + $1,
+                level = GREATEST(level, floor(sqrt((xp + $1) / 100.0))::int + 1)
+            WHERE telegram_id = $2
+            RETURNING level, xp - $1 AS prev_xp
+            """,
+            amount, user_id,
+        )
+    if not user:
+        return
 
-        user = await conn.fetchrow("SELECT level, xp FROM users WHERE telegram_id = $1", user_id)
-        if not user:
-            return
+    new_level = user['level']
+    if new_level > get_level_for_xp(user['prev_xp']):
+        await _invalidate_profile_cache(user_id)
+        if not silent_level_up and bot:
+            # Telegram RTT не должен задерживать вызывающего —
+            # уведомление уходит фоновой задачей.
+            _spawn_background(_send_level_up_message(bot, user_id, new_level))
+
+
+def _spawn_background(coro) -> None:
+    """Запускает корутину fire-and-forget, удерживая ссылку до её завершения."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
 
-        current_level, current_xp = user['level'], user['xp']
-        new_level = get_level_for_xp(current_xp)
 
-        if new_level > current_level:
-            await conn.execute("UPDATE users SET level = $1 WHERE telegram_id = $2", new_level, user_id)
-            await cache_service.delete_user_profile_from_cache(user_id)
-            if not silent_level_up:
-                try:
-                    level_up_text = f"🎉 {hbold('Новый уровень!')} 🎉\n\nПоздравляем, вы достигли {hbold(f'{new_level}-го уровня')}! Так держать!"
-                    if bot:
-                        await bot.send_message(user_id, level_up_text)
-                except Exception as e:
-                    logger.warning(f"Не удалось отправить уведомление о новом уровне пользователю {user_id}: {e}")
+async def _send_level_up_message(bot: Bot, user_id: int, new_level: int):
+    """Отправляет пользователю поздравление с новым уровнем."""
+    try:
+        level_up_text = f"🎉 {hbold('Новый уровень!')} 🎉\n\nПоздравляем, вы достигли {hbold(f'{new_level}-го уровня')}! Так держать!"
+        await bot.send_message(user_id, level_up_text)
+    except Exception as e:
+        logger.warning(f"Не удалось отправить уведомление о новом уровне пользователю {user_id}: {e}")
 
 
 async def grant_achievement(bot: Bot, user_id: int, achievement_code: str, silent: bool = False):
@@ -423,13 +688,13 @@ async def grant_achievement(bot: Bot, user_id: int, achievement_code: str, silen
     return None
 
 
-async def get_user_achievements_codes(user_id: int) -> set:
-    """Возвращает множество кодов достижений, полученных пользователем."""
-    pool = await get_db_pool()
+async def get_user_achievements_codes(user_id: int) -> frozenset[str]:
+    """Возвращает неизменяемое множество кодов достижений, полученных пользователем."""
+    pool = _POOL or await get_db_pool()
     async with pool.acquire() as conn:
         records = await conn.fetch("SELECT achievement_code FROM user_achievements WHERE user_telegram_id = $1",
                                    user_id)
-        return {rec['achievement_code'] for rec in records}
+        return frozenset(rec['achievement_code'] for rec in records)
 
 
 async def get_all_achievements() -> list[dict]:
@@ -438,7 +703,7 @@ async def get_all_achievements() -> list[dict]:
     if cached_achievements is not None:
         return cached_achievements
 
-    pool = await get_db_pool()
+    pool = _POOL or await get_db_pool()
     async with pool.acquire() as conn:
         records = await conn.fetch("SELECT * FROM achievements ORDER BY id")
         achievements = [dict(rec) for rec in records]
@@ -451,7 +716,7 @@ async def get_all_achievements() -> list[dict]:
 
 async def set_mobile_activation_code(telegram_id: int, code: str, expires_at: datetime) -> bool:
     """Сохраняет или обновляет код активации для мобильного приложения."""
-    pool = await get_db_pool()
+    pool = _POOL or await get_db_pool()
     async with pool.acquire() as conn:
         query = """
             INSERT INTO mobile_activation_codes (telegram_id, code, expires_at)
@@ -460,13 +725,12 @@ async def set_mobile_activation_code(telegram_id: int, code: str, expires_at: da
             SET code = $2, expires_at = $3
         """
         await conn.execute(query, telegram_id, code, expires_at)
-        await cache_service.delete_user_profile_from_cache(telegram_id)
         return True
 
 
 async def find_user_by_mobile_code(code: str) -> dict | None:
     """Находит пользователя по коду активации (если код не истёк)."""
-    pool = await get_db_pool()
+    pool = _POOL or await get_db_pool()
     async with pool.acquire() as conn:
         record = await conn.fetchrow(
             "SELECT u.* FROM users u JOIN mobile_activation_codes mac ON u.telegram_id = mac.telegram_id "
@@ -478,21 +742,18 @@ async def find_user_by_mobile_code(code: str) -> dict | None:
 
 async def clear_mobile_activation_code(telegram_id: int) -> bool:
     """Удаляет код активации для мобильного приложения после его использования."""
-    pool = await get_db_pool()
+    pool = _POOL or await get_db_pool()
     async with pool.acquire() as conn:
-        result = await conn.execute(
-            "DELETE FROM mobile_activation_codes WHERE telegram_id = $1",
-            telegram_id
+        return await _exec_and_invalidate(
+            conn, telegram_id,
+            "DELETE FROM mobile_activation_codes WHERE telegram_id = $1 RETURNING 1",
+            telegram_id,
         )
-        success = int(result.split(" ")[1]) > 0
-        if success:
-            await cache_service.delete_user_profile_from_cache(telegram_id)
-        return success
 
 
 async def register_user_device(telegram_id: int, fcm_token: str, platform: str) -> bool:
     """Сохраняет или обновляет FCM токен устройства для пользователя."""
-    pool = await get_db_pool()
+    pool = _POOL or await get_db_pool()
     async with pool.acquire() as conn:
         query = """
             INSERT INTO user_devices (user_telegram_id, fcm_token, platform, last_used_at)
@@ -511,28 +772,43 @@ async def register_user_device(telegram_id: int, fcm_token: str, platform: str)
 
 async def get_user_device_tokens(telegram_id: int) -> list[str]:
     """Получает все активные FCM токены для пользователя."""
-    pool = await get_db_pool()
+    pool = _POOL or await get_db_pool()
     async with pool.acquire() as conn:
-        query = "SELECT fcm_token FROM user_devices WHERE user_telegram_id = $1"
-        records = await conn.fetch(query, telegram_id)
-        return [rec['fcm_token'] for rec in records]
+        # array_agg отдаёт готовый list из декодера asyncpg (или NULL, если токенов нет).
+        tokens = await conn.fetchval(_Q_SELECT_DEVICE_TOKENS, telegram_id)
+        return tokens or []
 
 
 async def delete_user_device_token(fcm_token: str) -> bool:
     """Удаляет конкретный FCM токен из базы данных."""
-    pool = await get_db_pool()
+    pool = _POOL or await get_db_pool()
     async with pool.acquire() as conn:
-        result = await conn.execute("DELETE FROM user_devices WHERE fcm_token = $1", fcm_token)
-        deleted_count = int(result.split(" ")[1])
-        if deleted_count > 0:
+        deleted = await conn.fetchval("DELETE FROM user_devices WHERE fcm_token = $1 RETURNING 1", fcm_token)
+        if deleted is not None:
             logger.info(f"Удален невалидный FCM токен: {fcm_token[:15]}...")
             return True
         return False
 
 
+async def delete_device_tokens(fcm_tokens: list[str]) -> int:
+    """Удаляет пачку FCM токенов одним запросом. Возвращает число удалённых."""
+    if not fcm_tokens:
+        return 0
+    pool = _POOL or await get_db_pool()
+    async with pool.acquire() as conn:
+        deleted = await conn.fetchval(
+            "WITH d AS (DELETE FROM user_devices WHERE fcm_token = ANY($1::text[]) RETURNING 1) "
+            "SELECT count(*) FROM d",
+            fcm_tokens,
+        )
+    if deleted:
+        logger.info("Удалено невалидных FCM токенов: %s", deleted)
+    return deleted
+
+
 async def mark_guide_as_viewed(telegram_id: int, guide_topic: str) -> bool:
     """Добавляет топик гайда в список просмотренных пользователем."""
-    pool = await get_db_pool()
+    pool = _POOL or await get_db_pool()
     async with pool.acquire() as conn:
         query = """
                 UPDATE users
@@ -540,18 +816,15 @@ async def mark_guide_as_viewed(telegram_id: int, guide_topic: str) -> bool:
                     SELECT jsonb_agg(DISTINCT value)
                     FROM jsonb_array_elements_text(viewed_guides || $2::jsonb)
                 )
-                WHERE telegram_id = $1;
+                WHERE telegram_id = $1
+                RETURNING 1;
                 """
-        result = await conn.execute(query, telegram_id, json.dumps([guide_topic]))
-        success = int(result.split(" ")[1]) > 0
-        if success:
-            await cache_service.delete_user_profile_from_cache(telegram_id)
-        return success
+        return await _exec_and_invalidate(conn, telegram_id, query, telegram_id, json.dumps([guide_topic]))
 
 
 async def has_self_birthday_record(telegram_id: int) -> bool:
     """Проверяет, добавил ли пользователь свой день рождения."""
-    pool = await get_db_pool()
+    pool = _POOL or await get_db_pool()
     async with pool.acquire() as conn:
         query = """
                 SELECT 1 FROM birthdays
@@ -564,7 +837,7 @@ async def has_self_birthday_record(telegram_id: int) -> bool:
 
 async def get_all_users_with_habits() -> list[int]:
     """Возвращает ID всех пользователей, у которых есть хотя бы одна активная привычка."""
-    pool = await get_db_pool()
+    pool = _POOL or await get_db_pool()
     async with pool.acquire() as conn:
         query = "SELECT DISTINCT user_telegram_id FROM habits WHERE is_active = TRUE"
         records = await conn.fetch(query)
@@ -21,9 +21,12 @@ os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = service_account_key_path
 # Импортируем модули ПОСЛЕ установки переменной окружения
 from src.core.config import check_initial_config, TG_BOT_TOKEN
 from src.core.logging_setup import setup_logging
-from src.database.connection import init_db, close_db_pool
+from src.database.connection import init_db, close_db_pool, get_db_pool
+from src.database import user_repo
 from src.bot.dispatcher import get_dispatcher
 from src.services.scheduler import scheduler, load_reminders_on_startup, setup_daily_jobs
+from src.services import llm
+from src.services import push_service
 from src.services.push_service import initialize_firebase  # <-- ИМПОРТИРУЕМ НАШУ ФУНКЦИЮ
 from src.web.app import get_fastapi_app
 
@@ -32,9 +35,20 @@ check_initial_config()
 logger = logging.getLogger(__name__)
 
 
+# Фоновый прогрев соединений: ссылка держится, чтобы задачу не собрал GC
+# и чтобы on_shutdown мог её отменить.
+_warmup_task: asyncio.Task | None = None
+
+
+async def _warmup_connections():
+    """Прогревает соединения с DeepSeek и FCM параллельно."""
+    await asyncio.gather(llm.warmup_llm(), push_service.warmup_push())
+
+
 # --- Startup/Shutdown Events ---
 async def on_startup(bot: Bot):
     """Выполняется при запуске бота."""
+    global _warmup_task
     logger.info("Starting bot...")
 
     # Инициализируем Firebase SDK
@@ -42,6 +56,11 @@ async def on_startup(bot: Bot):
 
     await bot.delete_webhook(drop_pending_updates=True)
     await init_db()
+    user_repo.set_pool(await get_db_pool())
+    user_repo.start_user_action_logger()
+    user_repo.start_profile_cache_listener()
+    # Прогрев соединений идёт в фоне и не задерживает старт бота.
+    _warmup_task = asyncio.create_task(_warmup_connections())
 
     logger.info("Starting scheduler...")
     await load_reminders_on_startup(bot)
@@ -54,12 +73,25 @@ async def on_startup(bot: Bot):
 
 async def on_shutdown(bot: Bot):
     """Выполняется при остановке бота."""
+    global _warmup_task
     logger.info("Stopping bot...")
+    if _warmup_task is not None:
+        _warmup_task.cancel()
+        try:
+            await _warmup_task
+        except (asyncio.CancelledError, Exception):
+            pass
+        _warmup_task = None
     if scheduler.running:
         scheduler.shutdown(wait=False)
         logger.info("Scheduler stopped.")
 
+    await user_repo.stop_profile_cache_listener()
+    await user_repo.stop_user_action_logger()
+    user_repo.set_pool(None)
     await close_db_pool()
+    await llm.close_session()
+    await push_service.close_client()
 
     try:
         if bot and bot.session:
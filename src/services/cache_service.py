@@ -1,15 +1,14 @@
 # src/services/cache_service.py
-import json
 import logging
-from redis.asyncio import Redis
-from aiogram.fsm.storage.redis import RedisStorage
 
-from src.core.config import REDIS_URL
+import orjson
+from redis.asyncio import BlockingConnectionPool, Redis
+
+from src.core.config import REDIS_MAX_CONNECTIONS, REDIS_POOL_TIMEOUT_SECONDS, REDIS_URL
 
 logger = logging.getLogger(__name__)
 
 # --- Константы ---
-USER_PROFILE_CACHE_KEY = "user_profile:{user_id}"
 ALL_ACHIEVEMENTS_CACHE_KEY = "achievements:all"
 CACHE_TTL_SECONDS = 300  # 5 минут
 ACHIEVEMENTS_CACHE_TTL_SECONDS = 3600  # 1 час, т.к. меняются редко
@@ -19,31 +18,44 @@ _redis_client: Redis | None = None
 
 
 def get_redis_client() -> Redis:
-    """Возвращает экземпляр клиента Redis."""
+    """
+    Возвращает экземпляр клиента Redis.
+
+    Пул ограничен REDIS_MAX_CONNECTIONS и блокирующий: при всплеске нагрузки
+    команда ждёт свободное соединение (до REDIS_POOL_TIMEOUT_SECONDS), а не
+    падает с «Too many connections», как обычный ConnectionPool. Функция синхронная и не уступает управление event loop'у,
+    поэтому два клиента при конкурентном первом вызове не создаются — лок не нужен.
+    """
     global _redis_client
     if _redis_client is None:
-        # Используем парсер из aiogram, чтобы не дублировать логику подключения
-        storage = RedisStorage.from_url(REDIS_URL)
-        _redis_client = storage.redis
+        pool = BlockingConnectionPool.from_url(
+            REDIS_URL, max_connections=REDIS_MAX_CONNECTIONS, timeout=REDIS_POOL_TIMEOUT_SECONDS,
+        )
+        _redis_client = Redis(connection_pool=pool)
     return _redis_client
 
 
 # --- Функции для работы с кэшем профиля ---
 
+def _profile_key(user_id: int) -> bytes:
+    """Ключ профиля в Redis; %-форматирование bytes дешевле str.format на горячем пути."""
+    return b"user_profile:%d" % user_id
+
+
 async def get_user_profile_from_cache(user_id: int) -> dict | None:
     """
     Пытается получить профиль пользователя из кэша Redis.
     """
     redis = get_redis_client()
-    key = USER_PROFILE_CACHE_KEY.format(user_id=user_id)
+    key = _profile_key(user_id)
     cached_data = await redis.get(key)
 
     if cached_data:
         try:
-            profile = json.loads(cached_data)
+            profile = orjson.loads(cached_data)
             logger.debug(f"Кэш-хит для профиля пользователя {user_id}.")
             return profile
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             logger.warning(f"Ошибка декодирования JSON из кэша для пользователя {user_id}.")
             return None
 
@@ -55,15 +67,11 @@ async def set_user_profile_to_cache(user_id: int, profile_data: dict):
     """
     Сохраняет профиль пользователя в кэш Redis.
     """
-    # Конвертируем datetime и time в строки, т.к. JSON их не поддерживает напрямую
-    for key, value in profile_data.items():
-        if hasattr(value, 'isoformat'):
-            profile_data[key] = value.isoformat()
-
+    # orjson сам пишет datetime/date/time в ISO 8601 — ручной обход полей не нужен.
     redis = get_redis_client()
-    key = USER_PROFILE_CACHE_KEY.format(user_id=user_id)
+    key = _profile_key(user_id)
     try:
-        await redis.set(key, json.dumps(profile_data), ex=CACHE_TTL_SECONDS)
+        await redis.set(key, orjson.dumps(profile_data), ex=CACHE_TTL_SECONDS)
         logger.debug(f"Профиль пользователя {user_id} сохранен в кэш.")
     except Exception as e:
         logger.error(f"Не удалось сохранить профиль {user_id} в кэш: {e}")
@@ -74,7 +82,7 @@ async def delete_user_profile_from_cache(user_id: int):
     Удаляет (инвалидирует) кэш профиля пользователя.
     """
     redis = get_redis_client()
-    key = USER_PROFILE_CACHE_KEY.format(user_id=user_id)
+    key = _profile_key(user_id)
     await redis.delete(key)
     logger.info(f"Кэш для профиля пользователя {user_id} инвалидирован.")
 
@@ -87,10 +95,10 @@ async def get_all_achievements_from_cache() -> list[dict] | None:
     cached_data = await redis.get(ALL_ACHIEVEMENTS_CACHE_KEY)
     if cached_data:
         try:
-            achievements = json.loads(cached_data)
+            achievements = orjson.loads(cached_data)
             logger.debug("Кэш-хит для списка всех достижений.")
             return achievements
-        except json.JSONDecodeError:
+        except orjson.JSONDecodeError:
             logger.warning("Ошибка декодирования JSON из кэша для списка достижений.")
             return None
     logger.debug("Кэш-промах для списка всех достижений.")
@@ -101,7 +109,7 @@ async def set_all_achievements_to_cache(achievements_data: list[dict]):
     """Сохраняет список всех достижений в кэш."""
     redis = get_redis_client()
     try:
-        await redis.set(ALL_ACHIEVEMENTS_CACHE_KEY, json.dumps(achievements_data), ex=ACHIEVEMENTS_CACHE_TTL_SECONDS)
+        await redis.set(ALL_ACHIEVEMENTS_CACHE_KEY, orjson.dumps(achievements_data), ex=ACHIEVEMENTS_CACHE_TTL_SECONDS)
         logger.debug("Список всех достижений сохранен в кэш.")
     except Exception as e:
         logger.error(f"Не удалось сохранить список достижений в кэш: {e}")
\ No newline at end of file
@@ -1,16 +1,73 @@
 # src/services/llm.py
 import asyncio
-import json
+import copy
+import hashlib
+import html
 import logging
+import math
+import random
+import re
+import time
+from collections import Counter, OrderedDict
 from enum import Enum
 from datetime import datetime
 
 import aiohttp
-from ..core.config import DEEPSEEK_API_KEY, DEEPSEEK_API_URL, DEEPSEEK_MODEL_NAME
+import orjson
+from ..core.config import DEEPSEEK_API_KEY, DEEPSEEK_API_URL, DEEPSEEK_MAX_CONCURRENCY, DEEPSEEK_MODEL_NAME
 from ..services.tz_utils import get_day_of_week_str
 
 logger = logging.getLogger(__name__)
 
+# Одна сессия на процесс: keep-alive к хосту DeepSeek избавляет каждый запрос
+# от нового TCP+TLS рукопожатия. Создаётся лениво внутри event loop'а.
+_LLM_REQUEST_TIMEOUT_SECONDS = 90
+_session: aiohttp.ClientSession | None = None
+
+
+async def _get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=256, limit_per_host=64,
+            keepalive_timeout=75, use_dns_cache=True, ttl_dns_cache=600,
+            enable_cleanup_closed=True,
+        )
+        # sock_connect короткий: зависшее подключение не должно держать слот пула
+        # все 90 секунд, отведённые на генерацию ответа.
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(
+                total=_LLM_REQUEST_TIMEOUT_SECONDS, sock_connect=5, sock_read=_LLM_REQUEST_TIMEOUT_SECONDS,
+            ),
+        )
+    return _session
+
+
+async def warmup_llm():
+    """
+    Заранее открывает соединение к DeepSeek (DNS + TCP + TLS), чтобы первый
+    пользовательский запрос не платил за рукопожатие. Ответ на HEAD не важен —
+    соединение остаётся в пуле сессии. Ошибки только логируются.
+    """
+    if not DEEPSEEK_API_KEY:
+        return
+    try:
+        session = await _get_session()
+        async with session.head(DEEPSEEK_API_URL, timeout=aiohttp.ClientTimeout(total=5)):
+            pass
+        logger.info("Соединение с DeepSeek API прогрето.")
+    except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+        logger.warning(f"Не удалось прогреть соединение с DeepSeek API: {e}")
+
+
+async def close_session():
+    """Закрывает общую HTTP-сессию LLM. Вызывается при остановке приложения."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
 
 class UserIntent(Enum):
     CREATE_NOTE = "создание_заметки"
@@ -20,32 +77,51 @@ class UserIntent(Enum):
 
     @classmethod
     def _missing_(cls, value):
-        if isinstance(value, str):
-            value_lower = value.lower()
-            if "заметк" in value_lower:
-                return cls.CREATE_NOTE
-            if "покуп" in value_lower:
-                return cls.CREATE_SHOPPING_LIST
-            if "напоминани" in value_lower:
-                return cls.CREATE_REMINDER
-        return super()._missing_(value)
+        # None — Enum сам поднимет ValueError, без лишнего вызова super()._missing_.
+        if not isinstance(value, str):
+            return None
+        value_lower = value.lower()
+        for fragment, member in _INTENT_SYNONYMS:
+            if fragment in value_lower:
+                return member
+        return None
 
 
-def _parse_llm_json_response(response_text: str) -> dict:
-    import re
+# Фрагменты неточных ответов LLM → намерение. Вне класса: атрибут-кортеж
+# внутри Enum стал бы ещё одним его членом.
+_INTENT_SYNONYMS = (
+    ("заметк", UserIntent.CREATE_NOTE),
+    ("покуп", UserIntent.CREATE_SHOPPING_LIST),
+    ("напоминани", UserIntent.CREATE_REMINDER),
+)
+
+
+# Markdown fence вокруг JSON, перед которым модель написала ещё какой-то текст.
+# Компилируется один раз при импорте.
+_JSON_FENCE_RE = re.compile(r'```(?:json)?\s*(.*?)\s*```', re.DOTALL)
 
+
+def _extract_json_text(response_text: str) -> str:
+    """Достаёт JSON из ответа LLM, снимая markdown fence, если он есть."""
     text = response_text.strip()
+    if text.startswith("```"):
+        fences = text.count("```")
+        # Частый случай: весь ответ — один fence (закрытый в самом конце или
+        # незакрытый). Текст после закрывающего fence уводит в regex ниже.
+        if fences == 1 or (fences == 2 and text.endswith("```")):
+            return text.removeprefix("```json").removeprefix("```").removesuffix("```").strip()
+    if "```" in text:
+        fence_match = _JSON_FENCE_RE.search(text)
+        if fence_match:
+            return fence_match.group(1)
+    return text
+
 
-    # Извлекаем JSON из markdown fence (```json ... ``` или ``` ... ```)
-    fence_match = re.search(r'```(?:json)?\s*\n?(.*?)```', text, re.DOTALL)
-    if fence_match:
-        text = fence_match.group(1).strip()
-    elif text.startswith("```"):
-        # Незакрытый fence — убираем открывающий маркер
-        text = re.sub(r'^```(?:json)?\s*\n?', '', text).strip()
+def _parse_llm_json_response(response_text: str) -> dict:
+    text = _extract_json_text(response_text)
 
     try:
-        data = json.loads(text)
+        data = orjson.loads(text)
         if not isinstance(data, dict):
             # LLM иногда возвращает массив (например, search_notes_with_llm) — оборачиваем
             if isinstance(data, list):
@@ -53,17 +129,119 @@ def _parse_llm_json_response(response_text: str) -> dict:
             logger.warning(f"LLM вернула JSON, но это не словарь и не список: {type(data)}")
             return {"error": "LLM returned non-dict JSON"}
         return data
-    except (json.JSONDecodeError, TypeError) as e:
-        logger.error(f"Ошибка декодирования JSON от LLM: {e}. Ответ LLM: {text[:500]}...")
+    except (orjson.JSONDecodeError, TypeError) as e:
+        # %.500s обрезает ответ только если запись реально будет выведена.
+        logger.error("Ошибка декодирования JSON от LLM: %s. Ответ LLM: %.500s...", e, text)
         return {"error": "Failed to decode JSON from LLM"}
 
 
+# Точный LRU-кэш ответов LLM в памяти процесса. Кэшируются только успешные
+# ответы почти детерминированных вызовов: при высокой температуре (шутки,
+# сводка) повтор ответа — это баг, а не экономия. Записи живут ограниченное
+# время, чтобы ответы не «застывали» навсегда при смене модели или промпта.
+_RESPONSE_CACHE_MAX_ENTRIES = 5000
+_RESPONSE_CACHE_MAX_TEMPERATURE = 0.2
+_RESPONSE_CACHE_TTL_SECONDS = 6 * 60 * 60
+_response_cache: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+# Одинаковые запросы, которые уже летят к API: повторный вызов ждёт ту же задачу,
+# а не шлёт второй запрос (single-flight).
+_inflight: dict[str, asyncio.Task] = {}
+
+
+def _response_cache_key(system_prompt: str, user_prompt: str, is_json_output: bool, temperature: float,
+                        max_tokens: int) -> str:
+    raw = orjson.dumps(
+        {"s": system_prompt, "u": user_prompt, "t": temperature, "m": DEEPSEEK_MODEL_NAME, "j": is_json_output,
+         "n": max_tokens},
+        option=orjson.OPT_SORT_KEYS,
+    )
+    return hashlib.sha256(raw).hexdigest()
+
+
 async def _call_deepseek_api(system_prompt: str, user_prompt: str, is_json_output: bool = True,
-                             temperature: float = 0.1) -> dict:
-    if not all([DEEPSEEK_API_KEY, DEEPSEEK_API_URL, DEEPSEEK_MODEL_NAME]):
+                             temperature: float = 0.1, max_tokens: int = 2048) -> dict:
+    """
+    max_tokens стоит подбирать под ожидаемый ответ: генерация идёт до лимита,
+    и короткий лимит для ответов-флагов заметно сокращает время ответа.
+    """
+    if temperature > _RESPONSE_CACHE_MAX_TEMPERATURE:
+        return await _request_deepseek(system_prompt, user_prompt, is_json_output, temperature, max_tokens)
+
+    key = _response_cache_key(system_prompt, user_prompt, is_json_output, temperature, max_tokens)
+    cached = _response_cache.get(key)
+    if cached is not None:
+        expires_at, cached_result = cached
+        if expires_at > time.monotonic():
+            _response_cache.move_to_end(key)
+            # Копия: вызывающий код может менять результат на месте.
+            return copy.deepcopy(cached_result)
+        del _response_cache[key]
+
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(
+            _request_and_cache(key, system_prompt, user_prompt, is_json_output, temperature, max_tokens)
+        )
+        _inflight[key] = task
+        task.add_done_callback(lambda _task: _inflight.pop(key, None))
+    # shield: отмена одного из ожидающих не должна отменять общий запрос.
+    return copy.deepcopy(await asyncio.shield(task))
+
+
+async def _request_and_cache(key: str, system_prompt: str, user_prompt: str, is_json_output: bool,
+                             temperature: float, max_tokens: int) -> dict:
+    result = await _request_deepseek(system_prompt, user_prompt, is_json_output, temperature, max_tokens)
+    if "error" not in result:
+        _response_cache[key] = (time.monotonic() + _RESPONSE_CACHE_TTL_SECONDS, result)
+        if len(_response_cache) > _RESPONSE_CACHE_MAX_ENTRIES:
+            _response_cache.popitem(last=False)
+    return result
+
+
+# Ограничение параллельных запросов и повторы на временных сбоях API:
+# 408/429/5xx, таймаут и сетевые ошибки. Пауза — экспонента с джиттером
+# либо Retry-After, если сервер его прислал; семафор на паузу отпускается.
+_llm_semaphore = asyncio.Semaphore(DEEPSEEK_MAX_CONCURRENCY)
+# Конфигурация читается один раз при импорте, как и остальные настройки модуля.
+_API_CONFIGURED = bool(DEEPSEEK_API_KEY and DEEPSEEK_API_URL and DEEPSEEK_MODEL_NAME)
+# Ключ и тип тела не меняются между запросами — заголовки собираются один раз.
+_DEEPSEEK_HEADERS = {"Authorization": f"Bearer {DEEPSEEK_API_KEY}", "Content-Type": "application/json"}
+_RETRYABLE_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+_MAX_ATTEMPTS = 4
+_MAX_RETRY_DELAY_SECONDS = 30.0
+# Общий срок на все попытки вместе с паузами: без него 4 попытки по 90 секунд
+# держали бы пользователя в интерактивных сценариях (поиск, классификация) минутами.
+_LLM_TOTAL_DEADLINE_SECONDS = 120.0
+
+
+def _retry_delay(attempt: int, retry_after: str | None) -> float:
+    if retry_after:
+        try:
+            return min(max(float(retry_after), 0.0), _MAX_RETRY_DELAY_SECONDS)
+        except ValueError:
+            pass  # HTTP-date в Retry-After не разбираем — обычная экспонента
+    return min(2 ** attempt + random.random(), _MAX_RETRY_DELAY_SECONDS)
+
+
+async def _request_deepseek(system_prompt: str, user_prompt: str, is_json_output: bool,
+                            temperature: float, max_tokens: int) -> dict:
+    if not _API_CONFIGURED:
         return {"error": "DeepSeek API not configured"}
 
-    headers = {"Authorization": f"Bearer {DEEPSEEK_API_KEY}", "Content-Type": "application/json"}
+    deadline = asyncio.get_running_loop().time() + _LLM_TOTAL_DEADLINE_SECONDS
+    try:
+        async with asyncio.timeout_at(deadline):
+            return await _request_deepseek_with_retries(
+                system_prompt, user_prompt, is_json_output, temperature, max_tokens, deadline
+            )
+    except TimeoutError:
+        logger.error("DeepSeek не ответил за %s сек с учётом повторов.", _LLM_TOTAL_DEADLINE_SECONDS)
+        return {"error": "LLM API deadline exceeded"}
+
+
+async def _request_deepseek_with_retries(system_prompt: str, user_prompt: str, is_json_output: bool,
+                                         temperature: float, max_tokens: int, deadline: float) -> dict:
+
     payload = {
         "model": DEEPSEEK_MODEL_NAME,
         "messages": [
@@ -71,42 +249,67 @@ async def _call_deepseek_api(system_prompt: str, user_prompt: str, is_json_outpu
             {"role": "user", "content": user_prompt}
         ],
         "temperature": temperature,
-        "max_tokens": 2048,
+        "max_tokens": max_tokens,
     }
     if is_json_output:
         payload["response_format"] = {"type": "json_object"}
-
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                    DEEPSEEK_API_URL, headers=headers, json=payload, timeout=aiohttp.ClientTimeout(total=90)
-            ) as resp:
-                response_text = await resp.text()
-                if resp.status != 200:
-                    logger.error(f"Ошибка API DeepSeek, статус: {resp.status}. Ответ: {response_text[:500]}")
-                    return {"error": f"LLM API Error: Status {resp.status}"}
-
-                response_data = json.loads(response_text)
-                message_content_str = response_data.get('choices', [{}])[0].get('message', {}).get('content')
-                if not message_content_str:
-                    return {"error": "Empty content in LLM response"}
-
-                return _parse_llm_json_response(message_content_str) if is_json_output else {
-                    "content": message_content_str}
-
-    except asyncio.TimeoutError:
-        logger.error("Таймаут запроса к DeepSeek API (90 сек)")
-        return {"error": "LLM API timeout (90s)"}
-    except aiohttp.ClientError as e:
-        logger.error(f"Сетевая ошибка при запросе к DeepSeek: {e}")
-        return {"error": f"Network error: {e}"}
-    except Exception as e:
-        logger.exception(f"Неожиданная ошибка во время запроса к DeepSeek: {e}")
-        return {"error": f"Unexpected exception: {e}"}
-
-
-async def classify_intent(raw_text: str) -> dict:
-    system_prompt = f"""
+    # Тело сериализуем orjson сам; Content-Type уже выставлен в headers.
+    body = orjson.dumps(payload)
+
+    for attempt in range(_MAX_ATTEMPTS):
+        is_last_attempt = attempt == _MAX_ATTEMPTS - 1
+        retry_after = None
+        try:
+            async with _llm_semaphore:
+                session = await _get_session()
+                async with session.post(DEEPSEEK_API_URL, headers=_DEEPSEEK_HEADERS, data=body) as resp:
+                    # Байты идут прямо в orjson — без промежуточного декодирования тела в str.
+                    response_bytes = await resp.read()
+                    if resp.status != 200:
+                        if resp.status not in _RETRYABLE_STATUSES or is_last_attempt:
+                            if logger.isEnabledFor(logging.ERROR):
+                                logger.error(
+                                    "Ошибка API DeepSeek, статус: %s. Ответ: %s",
+                                    resp.status, response_bytes[:500].decode("utf-8", "replace"),
+                                )
+                            return {"error": f"LLM API Error: Status {resp.status}"}
+                        logger.warning("DeepSeek вернул %s, повтор (попытка %s/%s).",
+                                       resp.status, attempt + 1, _MAX_ATTEMPTS)
+                        retry_after = resp.headers.get("Retry-After")
+                    else:
+                        response_data = orjson.loads(response_bytes)
+                        message_content_str = response_data.get('choices', [{}])[0].get('message', {}).get('content')
+                        if not message_content_str:
+                            return {"error": "Empty content in LLM response"}
+
+                        return _parse_llm_json_response(message_content_str) if is_json_output else {
+                            "content": message_content_str}
+
+        except asyncio.TimeoutError:
+            if is_last_attempt:
+                logger.error("Таймаут запроса к DeepSeek API (90 сек)")
+                return {"error": "LLM API timeout (90s)"}
+            logger.warning("Таймаут DeepSeek, повтор (попытка %s/%s).", attempt + 1, _MAX_ATTEMPTS)
+        except aiohttp.ClientError as e:
+            if is_last_attempt:
+                logger.error("Сетевая ошибка при запросе к DeepSeek: %s", e)
+                return {"error": f"Network error: {e}"}
+            logger.warning("Сетевая ошибка DeepSeek: %s, повтор (попытка %s/%s).", e, attempt + 1, _MAX_ATTEMPTS)
+        except Exception as e:
+            logger.exception(f"Неожиданная ошибка во время запроса к DeepSeek: {e}")
+            return {"error": f"Unexpected exception: {e}"}
+
+        delay = _retry_delay(attempt, retry_after)
+        if asyncio.get_running_loop().time() + delay >= deadline:
+            # Пауза не укладывается в общий срок — ждать её впустую нет смысла.
+            logger.error("Повтор запроса к DeepSeek не укладывается в общий срок, прекращаем.")
+            return {"error": "LLM API deadline exceeded"}
+        await asyncio.sleep(delay)
+
+    return {"error": "LLM API retries exhausted"}  # недостижимо: последняя попытка всегда возвращает
+
+
+_CLASSIFY_INTENT_SYSTEM_PROMPT = f"""
 Ты — AI-классификатор. Твоя задача — проанализировать текст и определить основное намерение пользователя.
 Верни JSON с одним ключом "intent", значение которого может быть одним из следующих:
 - `{UserIntent.CREATE_SHOPPING_LIST.value}`: если текст явно является списком покупок.
@@ -114,18 +317,65 @@ async def classify_intent(raw_text: str) -> dict:
 - `{UserIntent.CREATE_NOTE.value}`: для всех остальных случаев (идеи, мысли, задачи без даты).
 - `{UserIntent.UNKNOWN.value}`: если текст бессмысленный или является простым приветствием.
 """
+
+
+# Правила для очевидных случаев, которые не требуют похода в LLM. Срабатывают
+# только при однозначном сигнале; всё спорное уходит в модель как раньше.
+_GREETING_RE = re.compile(
+    r"^\s*(?:привет\w*|здравствуй\w*|добрый\s+(?:день|вечер)|доброе\s+утро|hi|hello)[!.\s]*$", re.IGNORECASE
+)
+# Явный тип в начале текста («идея: …», «список покупок: …») важнее
+# любых эвристик по содержимому, поэтому проверяется первым.
+_NOTE_PREFIX_RE = re.compile(r"^\s*(?:иде[яи]|мысл[ьи]|заметк[аи])\s*[:\-—–]", re.IGNORECASE)
+_SHOPPING_PREFIX_RE = re.compile(r"^\s*(?:список\s+покупок|покупки)\s*[:\-—–]", re.IGNORECASE)
+_SHOPPING_RE = re.compile(r"\b(?:куп(?:и|ить)|докуп(?:и|ить)|приобрест\w*|список\s+покупок)\b", re.IGNORECASE)
+_TIME_RE = re.compile(
+    r"\b(?:завтра|послезавтра"
+    r"|через\s+(?:\d+\s+)?(?:минут\w*|час\w*|дн\w*|день|недел\w*|месяц\w*)"
+    r"|в\s+\d{1,2}[:.]\d{2}"
+    r"|в\s+(?:понедельник|вторник|среду|четверг|пятницу|субботу|воскресенье))\b",
+    re.IGNORECASE,
+)
+
+
+def _classify_intent_by_rules(raw_text: str) -> UserIntent | None:
+    """Возвращает намерение для однозначных текстов или None, если нужен LLM."""
+    text = raw_text.strip()
+    if not text or _GREETING_RE.match(text):
+        return UserIntent.UNKNOWN
+    if _NOTE_PREFIX_RE.match(text):
+        return UserIntent.CREATE_NOTE
+    if _SHOPPING_PREFIX_RE.match(text):
+        return UserIntent.CREATE_SHOPPING_LIST
+    has_time = _TIME_RE.search(text) is not None
+    mentions_shopping = _SHOPPING_RE.search(text) is not None
+    if has_time and not mentions_shopping:
+        return UserIntent.CREATE_REMINDER
+    if mentions_shopping and not has_time and "," in text:
+        return UserIntent.CREATE_SHOPPING_LIST
+    return None
+
+
+async def classify_intent(raw_text: str) -> dict:
+    intent = _classify_intent_by_rules(raw_text)
+    if intent is not None:
+        return {"intent": intent.value}
     user_prompt = f"Определи намерение в тексте: \"{raw_text}\""
-    return await _call_deepseek_api(system_prompt, user_prompt, is_json_output=True)
+    return await _call_deepseek_api(_CLASSIFY_INTENT_SYSTEM_PROMPT, user_prompt, is_json_output=True, max_tokens=64)
 
 
-async def get_fun_suggestion(user_name: str) -> str:
-    system_prompt = f"""
+_FUN_SUGGESTION_SYSTEM_PROMPT = """
 Ты — AI-ассистент с яркой личностью. Твоя роль: слегка ленивый, всезнающий, саркастичный, но в глубине души заботливый дворецкий.
 Тебя просит о помощи твой "человек", которому стало скучно. Ты должен придумать одно оригинальное, смешное и немного абсурдное занятие, чтобы его развлечь.
 Обращайся к пользователю по имени. Твой ответ должен быть коротким (2-3 предложения) и содержать только текст предложения, без лишних вступлений.
 """
+
+
+async def get_fun_suggestion(user_name: str) -> str:
     user_prompt = f"Придумай что-нибудь для пользователя по имени {user_name}, которому скучно."
-    result = await _call_deepseek_api(system_prompt, user_prompt, is_json_output=False, temperature=0.8)
+    result = await _call_deepseek_api(
+        _FUN_SUGGESTION_SYSTEM_PROMPT, user_prompt, is_json_output=False, temperature=0.8, max_tokens=256,
+    )
 
     if "error" in result:
         return "Так, моя нейронная сеть сейчас занята обдумыванием вечного. Попробуйте развлечь себя самостоятельно. У вас получится, я верю."
@@ -134,18 +384,19 @@ async def get_fun_suggestion(user_name: str) -> str:
                       "Знаете, иногда лучшее занятие — это насладиться моментом ничегонеделания. Но раз уж вы настаиваете... попробуйте научить свой носок новым трюкам.")
 
 
-async def extract_note_details(raw_text: str) -> dict:
-    system_prompt = """
+_NOTE_DETAILS_SYSTEM_PROMPT = """
 Ты — редактор заметок. Проанализируй текст и верни JSON с двумя ключами:
 - "summary_text": Краткая, действенная суть заметки (1-7 слов).
 - "corrected_text": Полная, грамматически верная версия оригинального текста.
 """
+
+
+async def extract_note_details(raw_text: str) -> dict:
     user_prompt = f"Обработай текст: \"{raw_text}\""
-    return await _call_deepseek_api(system_prompt, user_prompt, is_json_output=True)
+    return await _call_deepseek_api(_NOTE_DETAILS_SYSTEM_PROMPT, user_prompt, is_json_output=True, max_tokens=512)
 
 
-async def extract_shopping_list(raw_text: str) -> dict:
-    system_prompt = """
+_SHOPPING_LIST_SYSTEM_PROMPT = """
 Ты — AI для списков покупок. Твоя задача — извлечь из текста все товары и структурировать их.
 
 **ПРАВИЛА:**
@@ -218,29 +469,28 @@ async def extract_shopping_list(raw_text: str) -> dict:
   ]
 }
 """
-    user_prompt = f"Извлеки товары из: \"{raw_text}\""
-    return await _call_deepseek_api(system_prompt, user_prompt, is_json_output=True)
 
 
-async def extract_reminder_details(raw_text: str, current_user_datetime_iso: str) -> dict:
-    current_dt = datetime.fromisoformat(current_user_datetime_iso)
-    day_of_week = get_day_of_week_str(current_dt)
+async def extract_shopping_list(raw_text: str) -> dict:
+    user_prompt = f"Извлеки товары из: \"{raw_text}\""
+    return await _call_deepseek_api(_SHOPPING_LIST_SYSTEM_PROMPT, user_prompt, is_json_output=True, max_tokens=1024)
 
-    system_prompt = f"""
-Ты — умный AI-парсер времени и задач. Твоя задача — извлечь из текста суть задачи и все компоненты времени.
 
-**КОНТЕКСТ:** Текущая дата и время пользователя: `{current_user_datetime_iso}` (это {day_of_week}). Используй эту дату как точку отсчета для "сегодня", "завтра", "в среду" и т.д.
+_REMINDER_SYSTEM_PROMPT_INTRO = """
+Ты — умный AI-парсер времени и задач. Твоя задача — извлечь из текста суть задачи и все компоненты времени.
 
+"""
+_REMINDER_SYSTEM_PROMPT_RULES = """
 **ТВОЯ ЛИЧНОСТЬ:**
 - Ты внимательный и точный помощник
 - Ты понимаешь контекст и намерения пользователя
 - Ты учитываешь культурные особенности (рабочие дни, праздники)
 
 Твой ответ ДОЛЖЕН быть JSON-объектом следующей структуры:
-{{
+{
   "summary_text": "Краткая суть задачи (до 7 слов, в именительном падеже).",
   "corrected_text": "Полный исправленный текст (грамматически правильное предложение).",
-  "time_components": {{
+  "time_components": {
     "original_mention": "Фраза, которой было упомянуто время.",
     "relative_days": <int | null>,
     "relative_hours": <int | null>,
@@ -251,9 +501,9 @@ async def extract_reminder_details(raw_text: str, current_user_datetime_iso: str
     "set_hour": <int | null>,
     "set_minute": <int | null>,
     "is_today_explicit": <boolean | null>
-  }},
+  },
   "recurrence_rule": "Строка iCalendar RRULE или null."
-}}
+}
 
 **ПРАВИЛА АНАЛИЗА ВРЕМЕНИ:**
 
@@ -300,48 +550,55 @@ async def extract_reminder_details(raw_text: str, current_user_datetime_iso: str
 - Если время не упомянуто, time_components и recurrence_rule = null
 - Всегда проверяй разумность дат (не в прошлом, не слишком далеко в будущем - максимум 2 года)
 
-**ПРИМЕРЫ (учитывая, что сегодня {current_dt.strftime('%Y-%m-%d')}):**
-- **Вход:** "встреча с командой завтра в 10:00"
-- **Выход:** {{"summary_text": "Встреча с командой", "corrected_text": "Встреча с командой завтра в 10:00.", "time_components": {{"original_mention": "завтра в 10:00", "relative_days": 1, "set_hour": 10, "set_minute": 0}}, "recurrence_rule": null}}
+"""
+_REMINDER_SYSTEM_PROMPT_EXAMPLES = """- **Вход:** "встреча с командой завтра в 10:00"
+- **Выход:** {"summary_text": "Встреча с командой", "corrected_text": "Встреча с командой завтра в 10:00.", "time_components": {"original_mention": "завтра в 10:00", "relative_days": 1, "set_hour": 10, "set_minute": 0}, "recurrence_rule": null}
 
 - **Вход:** "позвонить маме в субботу вечером"
-- **Выход:** {{"summary_text": "Позвонить маме", "corrected_text": "Позвонить маме в субботу вечером.", "time_components": {{"original_mention": "в субботу вечером", "set_hour": 19, "set_minute": 0}}, "recurrence_rule": null}}
+- **Выход:** {"summary_text": "Позвонить маме", "corrected_text": "Позвонить маме в субботу вечером.", "time_components": {"original_mention": "в субботу вечером", "set_hour": 19, "set_minute": 0}, "recurrence_rule": null}
 
 - **Вход:** "Напомни мне 31.07 пойти в театр"
-- **Выход:** {{"summary_text": "Пойти в театр", "corrected_text": "Напомни мне 31.07 пойти в театр.", "time_components": {{"original_mention": "31.07", "set_day": 31, "set_month": 7}}, "recurrence_rule": null}}
+- **Выход:** {"summary_text": "Пойти в театр", "corrected_text": "Напомни мне 31.07 пойти в театр.", "time_components": {"original_mention": "31.07", "set_day": 31, "set_month": 7}, "recurrence_rule": null}
 
 - **Вход:** "просто мысль"
-- **Выход:** {{"summary_text": "Просто мысль", "corrected_text": "Просто мысль.", "time_components": null, "recurrence_rule": null}}
+- **Выход:** {"summary_text": "Просто мысль", "corrected_text": "Просто мысль.", "time_components": null, "recurrence_rule": null}
 
 - **Вход:** "платить за интернет каждый месяц 25го числа"
-- **Выход:** {{"summary_text": "Платить за интернет", "corrected_text": "Платить за интернет каждый месяц 25го числа.", "time_components": {{"original_mention": "25го числа", "set_day": 25}}, "recurrence_rule": "FREQ=MONTHLY;BYMONTHDAY=25"}}
+- **Выход:** {"summary_text": "Платить за интернет", "corrected_text": "Платить за интернет каждый месяц 25го числа.", "time_components": {"original_mention": "25го числа", "set_day": 25}, "recurrence_rule": "FREQ=MONTHLY;BYMONTHDAY=25"}
 
 - **Вход:** "пить витамины каждый день в 9 утра"
-- **Выход:** {{"summary_text": "Пить витамины", "corrected_text": "Пить витамины каждый день в 9 утра.", "time_components": {{"original_mention": "каждый день в 9 утра", "set_hour": 9, "set_minute": 0}}, "recurrence_rule": "FREQ=DAILY"}}
+- **Выход:** {"summary_text": "Пить витамины", "corrected_text": "Пить витамины каждый день в 9 утра.", "time_components": {"original_mention": "каждый день в 9 утра", "set_hour": 9, "set_minute": 0}, "recurrence_rule": "FREQ=DAILY"}
 
 - **Вход:** "встреча в понедельник в 15:00"
-- **Выход:** {{"summary_text": "Встреча", "corrected_text": "Встреча в понедельник в 15:00.", "time_components": {{"original_mention": "в понедельник в 15:00", "set_hour": 15, "set_minute": 0}}, "recurrence_rule": null}}
+- **Выход:** {"summary_text": "Встреча", "corrected_text": "Встреча в понедельник в 15:00.", "time_components": {"original_mention": "в понедельник в 15:00", "set_hour": 15, "set_minute": 0}, "recurrence_rule": null}
 """
+
+
+_REMINDER_SYSTEM_PROMPT_STATIC = (
+    _REMINDER_SYSTEM_PROMPT_INTRO + _REMINDER_SYSTEM_PROMPT_RULES + "**ПРИМЕРЫ:**\n" + _REMINDER_SYSTEM_PROMPT_EXAMPLES
+)
+
+
+async def extract_reminder_details(raw_text: str, current_user_datetime_iso: str) -> dict:
+    current_dt = datetime.fromisoformat(current_user_datetime_iso)
+    day_of_week = get_day_of_week_str(current_dt)
+
+    # Дата — единственная переменная часть, поэтому она идёт в самом конце:
+    # неизменный префикс попадает в серверный кэш контекста DeepSeek.
+    system_prompt = (
+        _REMINDER_SYSTEM_PROMPT_STATIC
+        + f'\n**КОНТЕКСТ:** Текущая дата и время пользователя: `{current_user_datetime_iso}` (это {day_of_week}, '
+        f'{current_dt:%Y-%m-%d}). Используй эту дату как точку отсчета для "сегодня", "завтра", "в среду" и т.д.\n'
+    )
     user_prompt = f"Извлеки данные из: \"{raw_text}\""
-    return await _call_deepseek_api(system_prompt, user_prompt, is_json_output=True)
+    return await _call_deepseek_api(system_prompt, user_prompt, is_json_output=True, max_tokens=1024)
 
 
-async def generate_digest_text(
-        user_name: str,
-        weather_forecast: str,
-        notes_for_prompt: str,
-        bdays_for_prompt: str,
-        upcoming_for_prompt: str,
-        overdue_for_prompt: str
-) -> dict:
-    """Генерирует текст утренней сводки с помощью LLM."""
-    # Определяем контекст для адаптации тона
-    has_many_tasks = notes_for_prompt and "На сегодня задач нет" not in notes_for_prompt and len(notes_for_prompt.split('\n')) > 3
-    has_overdue = overdue_for_prompt and "Нет пропущенных задач" not in overdue_for_prompt
-    has_few_tasks = notes_for_prompt and "На сегодня задач нет" not in notes_for_prompt and len(notes_for_prompt.split('\n')) <= 2
-    
-    system_prompt = f"""
-Ты — дружелюбный и мотивирующий AI-ассистент. Твоя задача — составить персональное утреннее сообщение для пользователя по имени {user_name}.
+# Сводку собираем сами: LLM пишет только приветствие и мотивирующую фразу
+# (короткий JSON), а блоки с погодой, задачами и днями рождения — это
+# детерминированная склейка, для которой генерация не нужна.
+_DIGEST_SYSTEM_PROMPT = """
+Ты — дружелюбный и мотивирующий AI-ассистент. Ты пишешь вступление и концовку персонального утреннего сообщения; блоки с погодой, задачами и днями рождения добавляются отдельно.
 
 **ТВОЯ ЛИЧНОСТЬ:**
 - Ты позитивный, но не навязчивый
@@ -349,75 +606,117 @@ async def generate_digest_text(
 - Ты мотивирующий, но не давящий
 - Ты адаптируешь тон под ситуацию
 
-**ПРАВИЛА СОСТАВЛЕНИЯ СВОДКИ:**
-
-1. **Структура:**
-   - Начни с персонализированного приветствия (используй разные варианты: "Доброе утро", "С добрым утром", "Приветствую" и т.д.)
-   - Если есть погода — добавь её с эмодзи 🌦️
-   - Задачи на сегодня — обязательно, если есть
-   - Задачи на неделю — только если есть
-   - Пропущенные задачи — только если есть (тон должен быть поддерживающим, не осуждающим)
-   - Дни рождения — только если есть
-   - Заверши мотивирующей фразой
-
-2. **Адаптация тона:**
-   - Если много задач → "У вас насыщенный день! Вы справитесь! 💪"
-   - Если пропущенные задачи → "Не переживайте, сегодня новый день! 🌟" или "Все в порядке, главное — двигаться вперед! 💪"
-   - Если задач мало → "Отличный день для новых свершений! 🚀"
-   - Если есть дни рождения → "Не забудьте поздравить близких! 🎂"
-
-3. **Форматирование:**
-   - Используй HTML-теги: <b> для заголовков, <i> для акцентов
-   - Используй эмодзи для визуального разделения
-   - Используй \\n для переносов строк (НЕ <br>)
-   - Будь кратким, но информативным
-
-4. **Важно:**
-   - НЕ включай блоки, которые пусты (содержат "Нет..." или "На сегодня задач нет")
-   - Используй разные формулировки для разнообразия
-   - Будь естественным, не роботичным
-   - Обращайся к пользователю по имени в приветствии
+Верни JSON-объект с двумя ключами:
+- "greeting": персонализированное приветствие по имени, одно предложение с эмодзи (используй разные варианты: "Доброе утро", "С добрым утром", "Приветствую" и т.д.).
+- "motivation": мотивирующая фраза в конце, 1-2 предложения с эмодзи.
+
+**Адаптация тона для "motivation":**
+- Если много задач → "У вас насыщенный день! Вы справитесь! 💪"
+- Если есть пропущенные задачи → "Не переживайте, сегодня новый день! 🌟" или "Все в порядке, главное — двигаться вперед! 💪"
+- Если задач мало → "Отличный день для новых свершений! 🚀"
+- Если есть дни рождения → "Не забудьте поздравить близких! 🎂"
+
+Используй разные формулировки для разнообразия, будь естественным, не роботичным. Без HTML-тегов.
 """
-    user_prompt = f"""
-Вот данные для сводки для пользователя {user_name}:
 
-**🌦️ Прогноз погоды:**
-{weather_forecast}
+_DIGEST_EMPTY_MARKERS = ("На сегодня задач нет",)
 
-**✅ Задачи на сегодня:**
-{notes_for_prompt}
 
-**🗓️ Задачи на ближайшие дни:**
-{upcoming_for_prompt}
+def _is_digest_block_empty(text: str | None) -> bool:
+    stripped = (text or "").strip()
+    return not stripped or stripped.startswith("Нет") or any(m in stripped for m in _DIGEST_EMPTY_MARKERS)
 
-**⏳ Пропущенные задачи:**
-{overdue_for_prompt}
 
-**🎂 Дни рождения на неделе:**
-{bdays_for_prompt}
----
-Сгенерируй финальное HTML-сообщение, строго следуя правилам. Будь естественным и дружелюбным.
-"""
-    return await _call_deepseek_api(system_prompt, user_prompt, is_json_output=False, temperature=0.5)
+def _digest_default_motivation(has_many_tasks: bool, has_overdue: bool, has_bdays: bool) -> str:
+    if has_overdue:
+        return "Не переживайте, сегодня новый день! 🌟"
+    if has_many_tasks:
+        return "У вас насыщенный день! Вы справитесь! 💪"
+    if has_bdays:
+        return "Не забудьте поздравить близких! 🎂"
+    return "Отличный день для новых свершений! 🚀"
 
 
-async def extract_habits_from_text(raw_text: str, current_user_datetime_iso: str) -> dict:
-    system_prompt = f"""
+def _assemble_digest_html(pieces: dict, weather_forecast: str, notes_for_prompt: str, bdays_for_prompt: str,
+                          upcoming_for_prompt: str, overdue_for_prompt: str) -> str:
+    """Собирает HTML сводки: приветствие, непустые блоки и мотивирующая фраза."""
+    blocks = [html.escape(pieces["greeting"])]
+    for icon, title, text in (
+        ("🌦️", "Погода", weather_forecast),
+        ("✅", "Задачи на сегодня", notes_for_prompt),
+        ("🗓️", "Задачи на ближайшие дни", upcoming_for_prompt),
+        ("⏳", "Пропущенные задачи", overdue_for_prompt),
+        ("🎂", "Дни рождения на неделе", bdays_for_prompt),
+    ):
+        if not _is_digest_block_empty(text):
+            blocks.append(f"{icon} <b>{title}:</b>\n{html.escape(text.strip())}")
+    blocks.append(f"<i>{html.escape(pieces['motivation'])}</i>")
+    return "\n\n".join(blocks)
+
+
+async def generate_digest_text(
+        user_name: str,
+        weather_forecast: str,
+        notes_for_prompt: str,
+        bdays_for_prompt: str,
+        upcoming_for_prompt: str,
+        overdue_for_prompt: str
+) -> dict:
+    """
+    Генерирует текст утренней сводки: LLM пишет приветствие и мотивацию,
+    остальное собирается в _assemble_digest_html. Если LLM недоступна,
+    используются стандартные фразы.
+    """
+    # Определяем контекст для адаптации тона
+    has_tasks = not _is_digest_block_empty(notes_for_prompt)
+    task_lines = len(notes_for_prompt.strip().split('\n')) if has_tasks else 0
+    has_many_tasks = task_lines > 3
+    has_few_tasks = has_tasks and task_lines <= 2
+    has_overdue = not _is_digest_block_empty(overdue_for_prompt)
+    has_bdays = not _is_digest_block_empty(bdays_for_prompt)
+
+    # Системный промпт одинаков для всех пользователей и целиком попадает
+    # в серверный кэш контекста; имя и сводные признаки — в user_prompt.
+    user_prompt = (
+        f"Имя пользователя: {user_name}\n"
+        f"Задач на сегодня: {task_lines}{' (много)' if has_many_tasks else ' (мало)' if has_few_tasks else ''}\n"
+        f"Есть пропущенные задачи: {'да' if has_overdue else 'нет'}\n"
+        f"Есть дни рождения на неделе: {'да' if has_bdays else 'нет'}\n"
+        f"Есть прогноз погоды: {'да' if not _is_digest_block_empty(weather_forecast) else 'нет'}"
+    )
+    result = await _call_deepseek_api(_DIGEST_SYSTEM_PROMPT, user_prompt, is_json_output=True,
+                                      temperature=0.5, max_tokens=256)
+
+    greeting = result.get("greeting")
+    motivation = result.get("motivation")
+    if "error" in result or not isinstance(greeting, str) or not isinstance(motivation, str):
+        logger.warning("LLM не вернула части сводки, используются стандартные фразы: %s", result.get("error"))
+        greeting = f"Доброе утро, {user_name}! ☀️"
+        motivation = _digest_default_motivation(has_many_tasks, has_overdue, has_bdays)
+
+    content = _assemble_digest_html(
+        {"greeting": greeting, "motivation": motivation},
+        weather_forecast, notes_for_prompt, bdays_for_prompt, upcoming_for_prompt, overdue_for_prompt,
+    )
+    return {"content": content}
+
+
+_HABITS_SYSTEM_PROMPT_INTRO = """
 Ты — AI-аналитик привычек. Твоя задача — извлечь из текста пользователя все желаемые привычки и их параметры.
-Контекст: Текущая дата и время пользователя: `{current_user_datetime_iso}`.
-Правила времени: "Утром" - 08:00, "Днем" - 14:00, "Вечером" - 20:00.
+"""
+_HABITS_SYSTEM_PROMPT_RULES = """Правила времени: "Утром" - 08:00, "Днем" - 14:00, "Вечером" - 20:00.
 Правила дней недели: "По будням" -> MO,TU,WE,TH,FR. "По выходным" -> SA,SU.
 
 Верни JSON-объект со списком привычек:
-{{
+{
   "habits": [
-    {{
+    {
       "name": "Краткое название привычки (2-4 слова в инфинитиве, например 'Делать зарядку')",
       "frequency_rule": "Строка iCalendar RRULE (например, FREQ=DAILY или FREQ=WEEKLY;BYDAY=SA,SU)",
       "reminder_time": "Время в формате HH:MM"
-    }}
+    }
   ]
-}}
+}
 
 ПРАВИЛА АНАЛИЗА:
 1.  "Каждый день" -> FREQ=DAILY.
@@ -425,56 +724,128 @@ async def extract_habits_from_text(raw_text: str, current_user_datetime_iso: str
 3.  Если время не указано, но есть "утром", "вечером" и т.д., подставь время по умолчанию. Если времени нет совсем, верни null для reminder_time.
 4.  Название привычки должно быть лаконичным и в инфинитиве.
 """
+
+
+async def extract_habits_from_text(raw_text: str, current_user_datetime_iso: str) -> dict:
+    system_prompt = (
+        _HABITS_SYSTEM_PROMPT_INTRO
+        + f"Контекст: Текущая дата и время пользователя: `{current_user_datetime_iso}`.\n"
+        + _HABITS_SYSTEM_PROMPT_RULES
+    )
     user_prompt = f"Извлеки привычки из текста: \"{raw_text}\""
     return await _call_deepseek_api(system_prompt, user_prompt, is_json_output=True)
 
 
-async def are_tasks_conflicting(task1_text: str, task2_text: str) -> bool:
-    system_prompt = """
+_TASKS_CONFLICTING_SYSTEM_PROMPT = """
 Ты — AI-аналитик продуктивности. Определи, конфликтуют ли две задачи по своей сути.
 Верни JSON с одним ключом "is_conflicting" (boolean).
 """
+
+
+async def are_tasks_conflicting(task1_text: str, task2_text: str) -> bool:
     user_prompt = f'Задача 1: "{task1_text}"\nЗадача 2: "{task2_text}"\n\nКонфликтуют ли они?'
-    result = await _call_deepseek_api(system_prompt, user_prompt, is_json_output=True)
+    result = await _call_deepseek_api(_TASKS_CONFLICTING_SYSTEM_PROMPT, user_prompt, is_json_output=True, max_tokens=32)
     if "error" in result:
         return False
     return result.get("is_conflicting", False)
 
 
-async def are_tasks_same(task1_text: str, task2_text: str) -> bool:
-    system_prompt = """
+_TASKS_SAME_SYSTEM_PROMPT = """
 Ты — AI-аналитик. Определи, являются ли две формулировки одной и той же задачей.
 Верни JSON с одним ключом "is_same" (boolean).
 """
+
+
+async def are_tasks_same(task1_text: str, task2_text: str) -> bool:
     user_prompt = f'Задача 1: "{task1_text}"\nЗадача 2: "{task2_text}"\n\nМожно сказать что они одинаковые?'
-    result = await _call_deepseek_api(system_prompt, user_prompt, is_json_output=True)
+    result = await _call_deepseek_api(_TASKS_SAME_SYSTEM_PROMPT, user_prompt, is_json_output=True, max_tokens=32)
     if "error" in result:
         return False
     return result.get("is_same", False)
 
 
+# Локальный BM25-префильтр: в промпт уходят только самые похожие на запрос заметки,
+# чтобы размер промпта не рос вместе с количеством заметок пользователя.
+_SEARCH_PREFILTER_TOP_K = 30
+_BM25_K1 = 1.5
+_BM25_B = 0.75
+_WORD_RE = re.compile(r"\w+")
+# Токены заметок между поисками: ключ (note_id, updated_at), так что
+# отредактированная заметка токенизируется заново, а старая запись вытесняется LRU.
+_NOTE_TOKENS_CACHE_MAX_ENTRIES = 20000
+_note_tokens_cache: OrderedDict[tuple, tuple[Counter, int]] = OrderedDict()
+
+
+def _tokenize(text: str) -> list[str]:
+    return _WORD_RE.findall(text.lower().replace("ё", "е"))
+
+
+def _note_term_counts(note: dict) -> tuple[Counter, int]:
+    key = (note.get("note_id"), note.get("updated_at"))
+    cached = _note_tokens_cache.get(key)
+    if cached is not None:
+        _note_tokens_cache.move_to_end(key)
+        return cached
+    counts = Counter(_tokenize(f"{note.get('summary_text') or ''} {note.get('corrected_text') or ''}"))
+    cached = (counts, sum(counts.values()))
+    if key[0] is not None:
+        _note_tokens_cache[key] = cached
+        if len(_note_tokens_cache) > _NOTE_TOKENS_CACHE_MAX_ENTRIES:
+            _note_tokens_cache.popitem(last=False)
+    return cached
+
+
+def _prefilter_notes_bm25(notes: list[dict], query: str, top_k: int = _SEARCH_PREFILTER_TOP_K) -> list[dict]:
+    """Возвращает top_k заметок по BM25 относительно запроса (исходный порядок сохраняется)."""
+    if len(notes) <= top_k:
+        return notes
+    query_terms = set(_tokenize(query))
+    if not query_terms:
+        return notes[:top_k]
+
+    indexed = [_note_term_counts(n) for n in notes]
+    docs = [counts for counts, _ in indexed]
+    lengths = [length for _, length in indexed]
+    avg_len = (sum(lengths) / len(lengths)) or 1.0
+    n_docs = len(docs)
+    idf = {}
+    for term in query_terms:
+        df = sum(1 for d in docs if term in d)
+        idf[term] = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+
+    scores = []
+    for i, (doc, length) in enumerate(zip(docs, lengths)):
+        norm = _BM25_K1 * (1 - _BM25_B + _BM25_B * length / avg_len)
+        score = 0.0
+        for term in query_terms:
+            tf = doc.get(term)
+            if tf:
+                score += idf[term] * tf * (_BM25_K1 + 1) / (tf + norm)
+        scores.append((score, i))
+
+    # При равных (в т.ч. нулевых) баллах выигрывают более ранние заметки.
+    scores.sort(key=lambda s: (-s[0], s[1]))
+    keep = sorted(i for _, i in scores[:top_k])
+    return [notes[i] for i in keep]
+
+
 async def search_notes_with_llm(notes: list[dict], query: str, max_results: int = 10) -> list[dict]:
     if not notes:
         return []
-    notes_for_llm = [
-        {
-            "id": n["note_id"],
-            "title": n.get("summary_text") or n.get("corrected_text", "")[:30],
-            "text": n.get("corrected_text", "")
-        }
-        for n in notes
-    ]
+    notes = _prefilter_notes_bm25(notes, query)
     system_prompt = (
         "Ты — интеллектуальный помощник. Пользователь ищет среди своих заметок. "
         "Твоя задача — выбрать наиболее релевантные заметки по запросу пользователя. "
         "Верни JSON-массив с объектами: id, title, snippet (короткий фрагмент из текста заметки, объясняющий релевантность). "
         "Сортируй по убыванию релевантности. Максимум 5 результатов."
     )
-    user_prompt = (
-        f"Запрос пользователя: {query}\n"
-        f"Список заметок (каждая на новой строке):\n" +
-        "\n".join([f"id: {n['id']}, title: {n['title']}, text: {n['text']}" for n in notes_for_llm])
+    # Строки заметок собираются за один проход, без промежуточного списка словарей.
+    note_lines = "\n".join(
+        f"id: {n['note_id']}, title: {n.get('summary_text') or n.get('corrected_text', '')[:30]}, "
+        f"text: {n.get('corrected_text', '')}"
+        for n in notes
     )
+    user_prompt = f"Запрос пользователя: {query}\nСписок заметок (каждая на новой строке):\n{note_lines}"
     llm_response = await _call_deepseek_api(system_prompt, user_prompt, is_json_output=True)
     if "error" in llm_response:
         return []
@@ -483,9 +854,14 @@ async def search_notes_with_llm(notes: list[dict], query: str, max_results: int
         results = llm_response
     if not results:
         return []
-    id_to_note = {n["note_id"]: n for n in notes}
+    # Индексируем только заметки, которые модель реально вернула (обычно ≤ 5),
+    # а не весь список пользователя.
+    wanted_ids = {item.get("id") for item in results if isinstance(item, dict)}
+    id_to_note = {n["note_id"]: n for n in notes if n["note_id"] in wanted_ids}
     found = []
     for item in results:
+        if not isinstance(item, dict):
+            continue
         note_id = item.get("id")
         if note_id in id_to_note:
             note = id_to_note[note_id]
@@ -1,12 +1,16 @@
 # src/services/push_service.py
 import logging
 import os
-import json
+import time
 import httpx
+import orjson
 import asyncio
+from datetime import timezone
 from google.oauth2 import service_account
 from google.auth.transport.requests import Request
 
+from src.database import user_repo
+
 logger = logging.getLogger(__name__)
 
 FIREBASE_INITIALIZED = False
@@ -14,6 +18,13 @@ PROJECT_ID = None
 SCOPES = ['https://www.googleapis.com/auth/firebase.messaging']
 FCM_V1_URL_TEMPLATE = "https://fcm.googleapis.com/v1/projects/{project_id}/messages:send"
 creds = None
+# Один HTTP/2-клиент на процесс: соединения с FCM переиспользуются между
+# пользователями и токенами, без TLS-рукопожатия на каждую рассылку.
+_http_client: httpx.AsyncClient | None = None
+# OAuth-токен живёт около часа: обновляем его заранее, а не на каждый push.
+_TOKEN_REFRESH_MARGIN_SECONDS = 60
+_token_cache = {"token": None, "expiry": 0.0}
+_token_lock = asyncio.Lock()
 
 
 def initialize_firebase():
@@ -30,8 +41,8 @@ def initialize_firebase():
         return
 
     try:
-        with open(creds_path, 'r') as f:
-            creds_json = json.load(f)
+        with open(creds_path, 'rb') as f:
+            creds_json = orjson.loads(f.read())
             PROJECT_ID = creds_json.get('project_id')
 
         if not PROJECT_ID:
@@ -46,10 +57,57 @@ def initialize_firebase():
         FIREBASE_INITIALIZED = False
 
 
-def get_access_token():
-    """Получает или обновляет токен доступа OAuth 2.0."""
-    creds.refresh(Request())
-    return creds.token
+def get_client() -> httpx.AsyncClient:
+    """Возвращает общий httpx-клиент для запросов к FCM, создавая его при первом вызове."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=100, keepalive_expiry=60),
+            timeout=httpx.Timeout(10.0, connect=5.0),
+        )
+    return _http_client
+
+
+async def warmup_push():
+    """
+    Заранее открывает соединение к FCM, чтобы первая рассылка не платила за
+    TCP+TLS рукопожатие. Статус ответа не важен; ошибки только логируются.
+    """
+    if not FIREBASE_INITIALIZED:
+        return
+    try:
+        await get_client().head("https://fcm.googleapis.com/", timeout=5)
+        logger.info("Соединение с FCM прогрето.")
+    except httpx.HTTPError as e:
+        logger.warning(f"Не удалось прогреть соединение с FCM: {e}")
+
+
+async def close_client():
+    """Закрывает общий httpx-клиент. Вызывается при остановке приложения."""
+    global _http_client
+    if _http_client is not None and not _http_client.is_closed:
+        await _http_client.aclose()
+    _http_client = None
+
+
+async def get_access_token():
+    """
+    Возвращает токен доступа OAuth 2.0 из кэша. Обновление — сетевой
+    синхронный вызов google-auth, поэтому он уходит в executor и выполняется
+    одним запросом даже при параллельных рассылках.
+    """
+    if _token_cache["expiry"] - _TOKEN_REFRESH_MARGIN_SECONDS > time.time():
+        return _token_cache["token"]
+    async with _token_lock:
+        if _token_cache["expiry"] - _TOKEN_REFRESH_MARGIN_SECONDS <= time.time():
+            await asyncio.get_running_loop().run_in_executor(None, lambda: creds.refresh(Request()))
+            _token_cache["token"] = creds.token
+            # google-auth хранит expiry как naive-datetime в UTC.
+            _token_cache["expiry"] = (
+                creds.expiry.replace(tzinfo=timezone.utc).timestamp() if creds.expiry else 0.0
+            )
+    return _token_cache["token"]
 
 
 async def send_push_to_user(telegram_id: int, title: str, body: str, data: dict = None):
@@ -62,7 +120,7 @@ async def send_push_to_user(telegram_id: int, title: str, body: str, data: dict
         logger.info(f"Для пользователя {telegram_id} не найдено FCM токенов для отправки push.")
         return
 
-    access_token = get_access_token()
+    access_token = await get_access_token()
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json',
@@ -70,13 +128,24 @@ async def send_push_to_user(telegram_id: int, title: str, body: str, data: dict
 
     fcm_url = FCM_V1_URL_TEMPLATE.format(project_id=PROJECT_ID)
 
-    async with httpx.AsyncClient() as client:
-        tasks = [send_single_push(client, fcm_url, headers, token, title, body, data, telegram_id) for token in tokens]
-        await asyncio.gather(*tasks)
+    client = get_client()
+    tasks = [send_single_push(client, fcm_url, headers, token, title, body, data, telegram_id) for token in tokens]
+    results = await asyncio.gather(*tasks)
+
+    # Невалидные токены удаляются одним DELETE после отправки, а не по одному.
+    invalid_tokens = [token for token, is_invalid in zip(tokens, results) if is_invalid]
+    if invalid_tokens:
+        try:
+            await user_repo.delete_device_tokens(invalid_tokens)
+        except Exception as e:
+            logger.error(f"Не удалось удалить невалидные FCM токены: {e}")
 
 
-async def send_single_push(client, url, headers, token, title, body, data, user_id):
-    """Отправляет одно уведомление и обрабатывает результат."""
+async def send_single_push(client, url, headers, token, title, body, data, user_id) -> bool:
+    """
+    Отправляет одно уведомление и обрабатывает результат.
+    Возвращает True, если FCM счёл токен невалидным и его нужно удалить.
+    """
     message_payload = {
         "message": {
             "token": token,
@@ -97,7 +166,7 @@ async def send_single_push(client, url, headers, token, title, body, data, user_
             # Логика удаления невалидных токенов
             if error_code in ("UNREGISTERED", "INVALID_ARGUMENT"):
                 logger.warning(f"Токен {token[:15]}... невалиден (причина: {error_code}). Удаляем из базы.")
-                await user_repo.delete_user_device_token(token)
+                return True
             else:
                 logger.error(
                     f"Ошибка HTTP при отправке push пользователю {user_id}: {response.status_code} - {response.text}")
@@ -106,6 +175,4 @@ async def send_single_push(client, url, headers, token, title, body, data, user_
         logger.error(f"Ошибка сети при отправке push пользователю {user_id}: {e}")
     except Exception as e:
         logger.error(f"Неожиданная ошибка при отправке push пользователю {user_id}: {e}", exc_info=True)
-
-
-from src.database import user_repo
\ No newline at end of file
+    return False
@@ -15,7 +15,7 @@ import asyncio
 import logging
 from datetime import datetime, timedelta, timezone
 from typing import Iterable
-from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from zoneinfo import ZoneInfo
 
 import httpx
 from sqlalchemy import and_, delete, or_, select, update
@@ -23,6 +23,7 @@ from sqlalchemy.ext.asyncio import async_sessionmaker
 
 from src.db.models import Moment, PushToken, User
 from src.services import push_service
+from src.services.tz_utils import get_zoneinfo
 
 logger = logging.getLogger(__name__)
 
@@ -33,10 +34,8 @@ POLL_INTERVAL_SEC = 60
 
 
 def _user_tz(user: User) -> ZoneInfo:
-    try:
-        return ZoneInfo(user.timezone)
-    except (ZoneInfoNotFoundError, AttributeError, TypeError):
-        return ZoneInfo("Europe/Moscow")
+    # Europe/Moscow — как server_default у User.timezone и в остальном новом стеке.
+    return get_zoneinfo(getattr(user, "timezone", None), "Europe/Moscow")
 
 
 async def _fcm_send(
@@ -323,15 +322,15 @@ async def _tick_digest(
 async def _tick(session_factory: async_sessionmaker) -> None:
     if not push_service.FIREBASE_INITIALIZED:
         return
-    access_token = push_service.get_access_token()
+    access_token = await push_service.get_access_token()
     headers = {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json",
     }
     fcm_url = push_service.FCM_V1_URL_TEMPLATE.format(project_id=push_service.PROJECT_ID)
-    async with httpx.AsyncClient() as client:
-        await _tick_reminders(session_factory, client, fcm_url, headers)
-        await _tick_digest(session_factory, client, fcm_url, headers)
+    client = push_service.get_client()
+    await _tick_reminders(session_factory, client, fcm_url, headers)
+    await _tick_digest(session_factory, client, fcm_url, headers)
 
 
 async def reminder_loop(
@@ -1,6 +1,8 @@
 # src/services/tz_utils.py
 import logging
-from datetime import datetime
+from datetime import datetime, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import pytz
 from dateutil.rrule import rrulestr, WEEKLY, DAILY, MONTHLY, YEARLY # Добавляем импорты
 logger = logging.getLogger(__name__)
@@ -25,6 +27,23 @@ COMMON_TIMEZONES = {
 ALL_PYTZ_TIMEZONES = pytz.all_timezones_set
 
 
+@lru_cache(maxsize=512)
+def get_zoneinfo(tz_str: str | None, default: str = 'UTC') -> ZoneInfo:
+    """
+    Единая точка получения часового пояса: ZoneInfo с кэшем.
+    Пустое или неизвестное имя заменяется на default — UTC для legacy-бота,
+    новый стек передаёт свой пояс по умолчанию (Europe/Moscow).
+    Кэшируется и результат для неизвестных имён, так что предупреждение пишется один раз.
+    """
+    if not tz_str:
+        return ZoneInfo(default)
+    try:
+        return ZoneInfo(tz_str)
+    except (ZoneInfoNotFoundError, ValueError):
+        logger.warning(f"Неизвестный часовой пояс '{tz_str}', используется {default}.")
+        return ZoneInfo(default)
+
+
 def guess_timezone_from_language(language_code: str | None) -> str:
     """
     Пытается определить часовой пояс на основе языка пользователя.
@@ -91,21 +110,13 @@ def format_datetime_for_user(
     # Если у пользователя не задан часовой пояс, используем пояс по умолчанию
     target_tz_str = user_tz_str or default_tz
 
-    try:
-        # Получаем объект часового пояса
-        target_tz = pytz.timezone(target_tz_str)
-    except pytz.UnknownTimeZoneError:
-        # Если в профиле пользователя некорректная таймзона, откатываемся к UTC
-        logger.warning(
-            f"Неизвестный часовой пояс '{target_tz_str}' в профиле. "
-            f"Используется UTC по умолчанию."
-        )
-        target_tz = pytz.timezone('UTC')
+    # Получаем объект часового пояса (из кэша); некорректная таймзона в профиле → UTC
+    target_tz = get_zoneinfo(target_tz_str)
 
     # Убедимся, что исходный datetime имеет информацию о часовом поясе (aware)
     # Если он naive (без tzinfo), предполагаем, что это UTC, как и хранится в нашей БД.
     if dt_obj.tzinfo is None:
-        dt_obj = pytz.utc.localize(dt_obj)
+        dt_obj = dt_obj.replace(tzinfo=timezone.utc)
 
     # Конвертируем время в целевой часовой пояс
     local_dt = dt_obj.astimezone(target_tz)
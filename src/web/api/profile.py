@@ -56,18 +56,8 @@ async def update_users_me(
             detail="No data provided to update."
         )
 
-    if 'timezone' in update_data:
-        await user_repo.set_user_timezone(user_id, update_data['timezone'])
-    if 'daily_digest_enabled' in update_data:
-        await user_repo.set_user_daily_digest_status(user_id, update_data['daily_digest_enabled'])
-    if 'daily_digest_time' in update_data:
-        await user_repo.set_user_daily_digest_time(user_id, update_data['daily_digest_time'])
-    if 'city_name' in update_data:
-        await user_repo.set_user_city(user_id, update_data['city_name'])
-    if 'default_reminder_time' in update_data:
-        await user_repo.set_user_default_reminder_time(user_id, update_data['default_reminder_time'])
-    if 'pre_reminder_minutes' in update_data:
-        await user_repo.set_user_pre_reminder_minutes(user_id, update_data['pre_reminder_minutes'])
+    # Все поля ProfileUpdateRequest — колонки users: один UPDATE вместо N.
+    await user_repo.update_user_fields(user_id, **update_data)
 
     updated_user = await user_repo.get_user_profile(user_id)
     if not updated_user:
@@ -4,7 +4,6 @@ FCM-отправка реального пуша — в M7, тут только
 """
 from __future__ import annotations
 
-import httpx
 from datetime import datetime, timezone
 from typing import Literal
 
@@ -78,7 +77,7 @@ async def send_test_push(
     if not tokens:
         raise HTTPException(404, "У пользователя нет зарегистрированных устройств")
 
-    access_token = push_service.get_access_token()
+    access_token = await push_service.get_access_token()
     headers = {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json",
@@ -87,35 +86,35 @@ async def send_test_push(
         project_id=push_service.PROJECT_ID
     )
     sent, failed = 0, []
-    async with httpx.AsyncClient(timeout=10) as client:
-        for token in tokens:
-            msg = {
-                "message": {
-                    "token": token,
-                    "notification": {"title": payload.title, "body": payload.body},
-                    "data": {
-                        "title": payload.title,
-                        "body": payload.body,
-                        "kind": "test",
+    client = push_service.get_client()
+    for token in tokens:
+        msg = {
+            "message": {
+                "token": token,
+                "notification": {"title": payload.title, "body": payload.body},
+                "data": {
+                    "title": payload.title,
+                    "body": payload.body,
+                    "kind": "test",
+                },
+                "android": {
+                    "priority": "high",
+                    "notification": {
+                        "channel_id": "reminder_v1",
+                        "default_sound": True,
+                        "default_vibrate_timings": True,
                     },
-                    "android": {
-                        "priority": "high",
-                        "notification": {
-                            "channel_id": "reminder_v1",
-                            "default_sound": True,
-                            "default_vibrate_timings": True,
-                        },
-                    },
-                }
+                },
             }
-            try:
-                resp = await client.post(fcm_url, headers=headers, json=msg)
-                if 200 <= resp.status_code < 300:
-                    sent += 1
-                else:
-                    failed.append({"prefix": token[:12], "status": resp.status_code, "err": resp.text[:200]})
-            except Exception as e:
-                failed.append({"prefix": token[:12], "err": str(e)[:200]})
+        }
+        try:
+            resp = await client.post(fcm_url, headers=headers, json=msg)
+            if 200 <= resp.status_code < 300:
+                sent += 1
+            else:
+                failed.append({"prefix": token[:12], "status": resp.status_code, "err": resp.text[:200]})
+        except Exception as e:
+            failed.append({"prefix": token[:12], "err": str(e)[:200]})
 
     return {"sent": sent, "total": len(tokens), "failed": failed}
 
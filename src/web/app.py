@@ -33,6 +33,7 @@ from .middleware import setup_rate_limiting
 
 import asyncio
 from src.db.session import AsyncSessionLocal
+from src.services import push_service
 from src.services.reminder_scheduler import reminder_loop
 
 
@@ -150,5 +151,8 @@ def get_fastapi_app(bot: Bot) -> FastAPI:
                 await task
             except (asyncio.CancelledError, Exception):
                 pass
+        # reminder_loop шлёт пуши через общий HTTP/2-клиент push_service —
+        # закрываем его пул после остановки цикла (повторный вызов из main безопасен).
+        await push_service.close_client()
 
     return app
\ No newline at end of file
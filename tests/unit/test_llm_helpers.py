@@ -0,0 +1,181 @@
+"""Unit-тесты чистых helper-функций legacy-модуля src/services/llm.py.
+
+Сеть не ходим: проверяем только разбор ответов и локальную логику вокруг LLM.
+"""
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from src.services import llm
+from src.services.llm import (
+    UserIntent,
+    _assemble_digest_html,
+    _classify_intent_by_rules,
+    _is_digest_block_empty,
+    _parse_llm_json_response,
+    _prefilter_notes_bm25,
+)
+
+
+class TestParseLlmJsonResponse:
+    @pytest.mark.parametrize("text", [
+        '{"a": 1}',
+        '  {"a": 1}\n',
+        '```json\n{"a": 1}\n```',
+        '```json\n{"a": 1}\n```\n',
+        '```\n{"a": 1}\n```',
+        '```json\n{"a": 1}',
+        'Вот результат:\n```json\n{"a": 1}\n```',
+        '```json\n{"a": 1}\n```\nSome note',
+    ])
+    def test_object(self, text: str) -> None:
+        assert _parse_llm_json_response(text) == {"a": 1}
+
+    def test_list_wrapped_in_results(self) -> None:
+        assert _parse_llm_json_response('[{"id": 1}]') == {"results": [{"id": 1}]}
+
+    def test_invalid_json_is_error(self) -> None:
+        assert "error" in _parse_llm_json_response("не JSON")
+
+    def test_scalar_json_is_error(self) -> None:
+        assert "error" in _parse_llm_json_response("42")
+
+
+class TestRequestDeadline:
+    async def test_total_deadline_caps_retries(self, monkeypatch) -> None:
+        async def _hang(*args, **kwargs):
+            await asyncio.sleep(10)
+
+        monkeypatch.setattr(llm, "_API_CONFIGURED", True)
+        monkeypatch.setattr(llm, "_LLM_TOTAL_DEADLINE_SECONDS", 0.05)
+        monkeypatch.setattr(llm, "_request_deepseek_with_retries", _hang)
+        result = await llm._request_deepseek("sys", "user", True, 0.1, 16)
+        assert result == {"error": "LLM API deadline exceeded"}
+
+
+class TestClassifyIntentByRules:
+    @pytest.mark.parametrize("text", ["", "   ", "привет", "Привет!", "Доброе утро!", "hello"])
+    def test_greeting_or_empty_is_unknown(self, text: str) -> None:
+        assert _classify_intent_by_rules(text) is UserIntent.UNKNOWN
+
+    @pytest.mark.parametrize("text", [
+        "идея: завтра обсудить план, важно",
+        "Идея — купить молоко, хлеб",
+        "мысль: через час позвонить",
+        "заметка - в 10:00 было интересно",
+    ])
+    def test_note_prefix_wins_over_time_and_shopping(self, text: str) -> None:
+        assert _classify_intent_by_rules(text) is UserIntent.CREATE_NOTE
+
+    @pytest.mark.parametrize("text", [
+        "список покупок: хлеб",
+        "Покупки - молоко, хлеб, завтра",
+    ])
+    def test_shopping_prefix(self, text: str) -> None:
+        assert _classify_intent_by_rules(text) is UserIntent.CREATE_SHOPPING_LIST
+
+    @pytest.mark.parametrize("text", [
+        "завтра в 10:00 встреча",
+        "напомни через 2 часа позвонить маме",
+        "позвонить в пятницу",
+    ])
+    def test_time_without_shopping_is_reminder(self, text: str) -> None:
+        assert _classify_intent_by_rules(text) is UserIntent.CREATE_REMINDER
+
+    def test_shopping_enumeration(self) -> None:
+        assert _classify_intent_by_rules("купить молоко, хлеб, сыр") is UserIntent.CREATE_SHOPPING_LIST
+
+    @pytest.mark.parametrize("text", [
+        "купить молоко завтра",   # покупка + время — решает LLM
+        "купить молоко",          # без перечисления — может быть задачей
+        "сделать отчёт",
+        "идеальный день",         # «иде…» без разделителя — не префикс
+    ])
+    def test_ambiguous_goes_to_llm(self, text: str) -> None:
+        assert _classify_intent_by_rules(text) is None
+
+
+def _note(note_id: int, text: str, updated_at: int = 1) -> dict:
+    return {"note_id": note_id, "corrected_text": text, "summary_text": None, "updated_at": updated_at}
+
+
+class TestPrefilterNotesBm25:
+    @pytest.fixture(autouse=True)
+    def _clear_token_cache(self):
+        llm._note_tokens_cache.clear()
+        yield
+        llm._note_tokens_cache.clear()
+
+    def test_small_collection_passes_through(self) -> None:
+        notes = [_note(i, f"заметка {i}") for i in range(llm._SEARCH_PREFILTER_TOP_K)]
+        assert _prefilter_notes_bm25(notes, "молоко") is notes
+
+    def test_keeps_top_k_with_match_in_original_order(self) -> None:
+        notes = [_note(i, f"заметка номер {i}") for i in range(100)]
+        notes[77] = _note(77, "купить молоко")
+        out = _prefilter_notes_bm25(notes, "Молоко")
+        ids = [n["note_id"] for n in out]
+        assert len(out) == llm._SEARCH_PREFILTER_TOP_K
+        assert 77 in ids
+        assert ids == sorted(ids)
+
+    def test_yo_folded_to_ye(self) -> None:
+        notes = [_note(i, f"заметка {i}") for i in range(100)]
+        notes[90] = _note(90, "ёлка на праздник")
+        assert 90 in [n["note_id"] for n in _prefilter_notes_bm25(notes, "елка")]
+
+    def test_query_without_words_keeps_first_notes(self) -> None:
+        notes = [_note(i, f"заметка {i}") for i in range(100)]
+        assert _prefilter_notes_bm25(notes, "?!") == notes[:llm._SEARCH_PREFILTER_TOP_K]
+
+    def test_token_cache_keyed_on_updated_at(self) -> None:
+        notes = [_note(i, f"заметка {i}") for i in range(100)]
+        _prefilter_notes_bm25(notes, "молоко")
+        assert len(llm._note_tokens_cache) == 100
+
+        # Та же версия заметки берётся из кэша, новая версия токенизируется заново.
+        notes[95] = _note(95, "купить молоко", updated_at=2)
+        out = _prefilter_notes_bm25(notes, "молоко")
+        assert 95 in [n["note_id"] for n in out]
+        assert (95, 2) in llm._note_tokens_cache
+
+
+class TestDigestAssembly:
+    @pytest.mark.parametrize("text, empty", [
+        ("", True),
+        ("   ", True),
+        (None, True),
+        ("Нет пропущенных задач", True),
+        ("На сегодня задач нет 🎉", True),
+        ("- Купить хлеб", False),
+    ])
+    def test_is_block_empty(self, text, empty: bool) -> None:
+        assert _is_digest_block_empty(text) is empty
+
+    def test_skips_empty_blocks_and_keeps_order(self) -> None:
+        html_text = _assemble_digest_html(
+            {"greeting": "Доброе утро, Вадим!", "motivation": "Вперёд!"},
+            weather_forecast="Солнечно, +20",
+            notes_for_prompt="- Купить хлеб",
+            bdays_for_prompt="Нет дней рождения",
+            upcoming_for_prompt="",
+            overdue_for_prompt="- Сдать отчёт",
+        )
+        assert html_text == (
+            "Доброе утро, Вадим!\n\n"
+            "🌦️ <b>Погода:</b>\nСолнечно, +20\n\n"
+            "✅ <b>Задачи на сегодня:</b>\n- Купить хлеб\n\n"
+            "⏳ <b>Пропущенные задачи:</b>\n- Сдать отчёт\n\n"
+            "<i>Вперёд!</i>"
+        )
+
+    def test_escapes_user_and_llm_text(self) -> None:
+        html_text = _assemble_digest_html(
+            {"greeting": "Привет, <Вадим>", "motivation": "a & b"},
+            "", "- купить <молоко>", "", "", "",
+        )
+        assert "&lt;Вадим&gt;" in html_text
+        assert "- купить &lt;молоко&gt;" in html_text
+        assert "<i>a &amp; b</i>" in html_text
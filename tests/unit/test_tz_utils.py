@@ -0,0 +1,36 @@
+"""Unit-тесты src/services/tz_utils.py: единый кэшируемый хелпер часовых поясов."""
+from __future__ import annotations
+
+from datetime import datetime, timezone
+
+import pytest
+
+from src.services.tz_utils import format_datetime_for_user, get_zoneinfo
+
+
+class TestGetZoneinfo:
+    def test_known_zone(self) -> None:
+        assert get_zoneinfo("Europe/Moscow").key == "Europe/Moscow"
+
+    @pytest.mark.parametrize("name", [None, "", "Bad/Zone", "../etc"])
+    def test_empty_or_unknown_falls_back_to_utc(self, name) -> None:
+        assert get_zoneinfo(name).key == "UTC"
+
+    @pytest.mark.parametrize("name", [None, "Bad/Zone"])
+    def test_explicit_default(self, name) -> None:
+        assert get_zoneinfo(name, "Europe/Moscow").key == "Europe/Moscow"
+
+    def test_cached(self) -> None:
+        assert get_zoneinfo("Asia/Omsk") is get_zoneinfo("Asia/Omsk")
+
+
+class TestFormatDatetimeForUser:
+    def test_naive_is_treated_as_utc(self) -> None:
+        assert format_datetime_for_user(datetime(2024, 1, 1, 12), "Europe/Moscow") == "01.01.2024 15:00 (MSK)"
+
+    def test_unknown_zone_uses_utc(self) -> None:
+        dt = datetime(2024, 1, 1, 12, tzinfo=timezone.utc)
+        assert format_datetime_for_user(dt, "Bad/Zone") == "01.01.2024 12:00 (UTC)"
+
+    def test_none(self) -> None:
+        assert format_datetime_for_user(None, "UTC") is None
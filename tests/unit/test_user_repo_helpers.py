@@ -0,0 +1,119 @@
+"""Unit-тесты чистых helper-функций src/database/user_repo.py (без БД)."""
+from __future__ import annotations
+
+from contextlib import asynccontextmanager
+from datetime import datetime, time, timezone
+
+import pytest
+
+from src.database import user_repo
+from src.database.user_repo import _build_update_user_fields_query
+
+
+class TestBuildUpdateUserFieldsQuery:
+    def test_columns_sorted_and_id_last(self) -> None:
+        query, params = _build_update_user_fields_query(42, {"timezone": "UTC", "is_vip": True})
+        assert params == [True, "UTC", 42]
+        assert "SET is_vip = $1, timezone = $2, updated_at = NOW()" in query
+        assert "WHERE telegram_id = $3" in query
+
+    def test_update_only_when_value_differs(self) -> None:
+        query, _ = _build_update_user_fields_query(42, {"timezone": "UTC", "is_vip": True})
+        assert "(is_vip IS DISTINCT FROM $1 OR timezone IS DISTINCT FROM $2)" in query
+
+    def test_returns_changed_flag_for_existing_user(self) -> None:
+        # Для существующего юзера — true/false (изменилась ли строка), для отсутствующего — NULL.
+        query, _ = _build_update_user_fields_query(42, {"city_name": "Москва"})
+        assert query.startswith("WITH upd AS (UPDATE users SET")
+        assert query.endswith("SELECT EXISTS (SELECT 1 FROM upd) FROM users WHERE telegram_id = $2")
+
+    def test_same_fields_give_same_sql(self) -> None:
+        q1, _ = _build_update_user_fields_query(1, {"a_field": 1, "b_field": 2})
+        q2, _ = _build_update_user_fields_query(2, {"b_field": 3, "a_field": 4})
+        assert q1 == q2
+
+
+class _FakePool:
+    def __init__(self, fetchval_result=None, fetch_result=()) -> None:
+        self.fetchval_result = fetchval_result
+        self.fetch_result = list(fetch_result)
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield self
+
+    async def fetchval(self, query: str, *args):
+        return self.fetchval_result
+
+    async def fetch(self, query: str, *args):
+        return self.fetch_result
+
+
+class TestUpdateUserFieldsInvalidation:
+    @pytest.fixture
+    def deleted(self, monkeypatch) -> list:
+        calls: list = []
+
+        async def _delete(telegram_id: int) -> None:
+            calls.append(telegram_id)
+
+        monkeypatch.setattr(user_repo.cache_service, "delete_user_profile_from_cache", _delete)
+        return calls
+
+    @pytest.mark.parametrize("changed, found, invalidated", [
+        (True, True, [42]),
+        (False, True, []),   # те же значения — кэш профиля не трогаем
+        (None, False, []),   # пользователя нет
+    ])
+    async def test_invalidates_only_changed_row(self, monkeypatch, deleted: list,
+                                                changed, found: bool, invalidated: list) -> None:
+        monkeypatch.setattr(user_repo, "_POOL", _FakePool(changed))
+        assert await user_repo.update_user_fields(42, city_name="Москва") is found
+        assert deleted == invalidated
+
+
+class _FrozenDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return datetime(2024, 6, 1, 5, 30, tzinfo=timezone.utc).astimezone(tz)
+
+
+class TestGetVipUsersForDigest:
+    async def test_filters_by_local_digest_hour(self, monkeypatch) -> None:
+        def _user(telegram_id: int, tz: str | None, hour: int) -> dict:
+            return {"telegram_id": telegram_id, "first_name": "x", "timezone": tz,
+                    "daily_digest_time": time(hour, 0), "city_name": None}
+
+        rows = [
+            _user(1, "Europe/Moscow", 8),   # 05:30 UTC = 08:30 MSK — час совпал
+            _user(2, "Europe/Moscow", 9),
+            _user(3, None, 5),              # пустой пояс — UTC
+            _user(4, "Bad/Zone", 5),        # неизвестный пояс — UTC
+            _user(5, "Europe/Kiev", 8),     # устаревший алиас нормализуется
+        ]
+        monkeypatch.setattr(user_repo, "_POOL", _FakePool(fetch_result=rows))
+        monkeypatch.setattr(user_repo, "datetime", _FrozenDatetime)
+        users = await user_repo.get_vip_users_for_digest()
+        assert [u["telegram_id"] for u in users] == [1, 3, 4, 5]
+
+
+class TestOnUserProfileChanged:
+    @pytest.fixture
+    def spawned(self, monkeypatch) -> list:
+        calls: list = []
+
+        def _spawn(coro) -> None:
+            coro.close()
+            calls.append(coro)
+
+        monkeypatch.setattr(user_repo, "_spawn_background", _spawn)
+        return calls
+
+    def test_numeric_payload_invalidates(self, spawned: list) -> None:
+        user_repo._on_user_profile_changed(None, 1, "user_profile_changed", "42")
+        assert len(spawned) == 1
+
+    @pytest.mark.parametrize("payload", ["", "None", "abc"])
+    def test_empty_or_garbage_payload_is_skipped(self, spawned: list, payload: str) -> None:
+        user_repo._on_user_profile_changed(None, 1, "user_profile_changed", payload)
+        assert spawned == []